@@ -0,0 +1,200 @@
+r"""
+Post-process the per-micro-batch timings the stages record
+(StageBase.timings) into utilisation numbers for each stage.
+
+For every stage a micro-batch goes through these phases:
+
+    arrive -> received                 blocked in to_here waiting for the previous stage
+    received -> start                  waiting for the stage lock (another micro-batch)
+    start -> end                       computing forward
+    backward_start -> backward_end     computing backward, once the step runs it
+
+Everything in the step window that is neither forward nor backward compute
+is bubble. Backward intervals of different micro-batches can overlap on one
+stage (distributed autograd runs them interleaved on one engine thread), so
+busy time is the union of the intervals, not their sum, and the cost of one
+micro-batch is that union over the micro-batch count.
+"""
+
+import json
+import sys
+
+
+def analyze(stage_timings, t0=None, t1=None, split_size=None):
+    r"""
+    ``stage_timings`` holds one list of timing records per stage. ``t0``/``t1``
+    bound the step; by default the first arrival and the last forward or
+    backward end are used.
+    """
+    records = [r for stage in stage_timings for r in stage]
+    if not records:
+        raise ValueError("no timings recorded")
+    if t0 is None:
+        t0 = min(r["arrive"] for r in records)
+    if t1 is None:
+        t1 = max(r.get("backward_end", r["end"]) for r in records)
+    window = t1 - t0
+
+    stages = []
+    for i, timings in enumerate(stage_timings):
+        forward = sum(r["end"] - r["start"] for r in timings)
+        backward = union_length(backward_intervals(timings))
+        busy = busy_time(timings)
+        recv_wait = sum(r["received"] - r["arrive"] for r in timings)
+        lock_wait = sum(r["start"] - r["received"] for r in timings)
+        per_mb = busy / len(timings) if timings else 0.0
+        first = min((r["start"] for r in timings), default=t0)
+        last = max((r.get("backward_end", r["end"]) for r in timings), default=t0)
+        stages.append({
+            "stage": i,
+            "micro_batches": len(timings),
+            "busy": busy,
+            "forward": forward,
+            "backward": backward,
+            "busy_pct": 100 * busy / window,
+            "bubble_pct": 100 * (1 - busy / window),
+            "fill": first - t0,
+            "drain": t1 - last,
+            "recv_wait": recv_wait,
+            "lock_wait": lock_wait,
+            "per_micro_batch": per_mb,
+        })
+
+    slowest = max(stages, key=lambda s: s["per_micro_batch"])
+    num_mb = max(s["micro_batches"] for s in stages)
+    # with perfect overlap the step is one pass through every stage plus
+    # (m - 1) more micro-batches through the slowest one
+    best_step = sum(s["per_micro_batch"] for s in stages) + (num_mb - 1) * slowest["per_micro_batch"]
+
+    result = {
+        "window": window,
+        "stages": stages,
+        "bottleneck": slowest["stage"],
+        "best_step": best_step,
+        "best_throughput": 1 / slowest["per_micro_batch"] if slowest["per_micro_batch"] else 0.0,
+        "critical_path": critical_path(stage_timings),
+        "suggestion": suggest_cut(stages),
+    }
+    if split_size is not None:
+        result["best_samples_per_sec"] = result["best_throughput"] * split_size
+    return result
+
+
+def backward_intervals(timings):
+    return [(r["backward_start"], r["backward_end"]) for r in timings if "backward_end" in r]
+
+
+def busy_time(timings):
+    r"""
+    Length of the union of a stage's forward and backward intervals.
+    """
+    return union_length([(r["start"], r["end"]) for r in timings] + backward_intervals(timings))
+
+
+def union_length(intervals):
+    busy = 0.0
+    cur_start, cur_end = None, None
+    for start, end in sorted(intervals):
+        if cur_end is None or start > cur_end:
+            if cur_end is not None:
+                busy += cur_end - cur_start
+            cur_start, cur_end = start, end
+        else:
+            cur_end = max(cur_end, end)
+    if cur_end is not None:
+        busy += cur_end - cur_start
+    return busy
+
+
+def critical_path(stage_timings):
+    r"""
+    Longest chain of dependent work through the forward pass. A micro-batch on
+    stage ``s`` waits for the same micro-batch on stage ``s - 1`` (data) and
+    for whatever stage ``s`` computed just before it (the stage lock); the
+    path follows whichever of the two finished last, from the final output
+    back to the start. Returns (stage, micro-batch, kind) hops in time order.
+
+    Records without a micro-batch number (stages called without ``mb``) are
+    matched across stages by arrival order instead.
+    """
+    by_key = {}
+    order = []
+    for s, timings in enumerate(stage_timings):
+        arrived = sorted(timings, key=lambda r: r["arrive"])
+        keyed = [(r["mb"] if r["mb"] is not None else i, r) for i, r in enumerate(arrived)]
+        keyed.sort(key=lambda kr: kr[1]["start"])
+        order.append(keyed)
+        for mb, r in keyed:
+            by_key[(s, mb)] = r
+
+    last_stage = len(stage_timings) - 1
+    if not order[last_stage]:
+        return []
+    node = (last_stage, order[last_stage][-1][0])
+    path = []
+    while node is not None:
+        s, mb = node
+        r = by_key[node]
+        data = by_key.get((s - 1, mb)) if s > 0 else None
+        prev_idx = [k for k, _ in order[s]].index(mb) - 1
+        prev_mb, prev = order[s][prev_idx] if prev_idx >= 0 else (None, None)
+
+        if data is None and prev is None:
+            path.append((s, mb, "compute"))
+            break
+        if prev is None or (data is not None and data["end"] >= prev["end"]):
+            path.append((s, mb, "compute after transfer"))
+            node = (s - 1, mb)
+        else:
+            path.append((s, mb, "compute after stage lock"))
+            node = (s, prev_mb)
+    path.reverse()
+    return path
+
+
+def suggest_cut(stages):
+    r"""
+    Point at the cut to move: between the bottleneck stage and whichever
+    neighbour is less loaded, shifting layers towards the neighbour.
+    """
+    if len(stages) < 2:
+        return None
+    b = max(range(len(stages)), key=lambda i: stages[i]["per_micro_batch"])
+    neighbours = [n for n in (b - 1, b + 1) if 0 <= n < len(stages)]
+    n = min(neighbours, key=lambda i: stages[i]["per_micro_batch"])
+    gap = stages[b]["per_micro_batch"] - stages[n]["per_micro_batch"]
+    return {
+        "bottleneck": b,
+        "neighbour": n,
+        "cut": (min(b, n), max(b, n)),
+        "move": f"move the cut between stage {min(b, n)} and stage {max(b, n)} {'later' if n < b else 'earlier'} "
+                f"so stage {b} hands layers to stage {n}",
+        "imbalance": gap,
+        "target_shift": gap / 2,
+    }
+
+
+def print_analysis(result):
+    print(f"step window: {result['window']:.3f}s, best possible step: {result['best_step']:.3f}s")
+    print(f"{'stage':<8}{'busy %':>8}{'bubble %':>10}{'fill s':>9}{'drain s':>9}{'fwd s':>9}{'bwd s':>9}"
+          f"{'recv wait s':>13}{'lock wait s':>13}{'per mb s':>10}")
+    for s in result["stages"]:
+        print(f"{s['stage']:<8}{s['busy_pct']:>8.1f}{s['bubble_pct']:>10.1f}{s['fill']:>9.3f}{s['drain']:>9.3f}"
+              f"{s['forward']:>9.3f}{s['backward']:>9.3f}"
+              f"{s['recv_wait']:>13.3f}{s['lock_wait']:>13.3f}{s['per_micro_batch']:>10.4f}")
+    line = f"bottleneck: stage {result['bottleneck']}, best throughput {result['best_throughput']:.1f} micro-batches/s"
+    if "best_samples_per_sec" in result:
+        line += f" ({result['best_samples_per_sec']:.1f} samples/s)"
+    print(line)
+    path = result["critical_path"]
+    if path:
+        print("critical path: " + " -> ".join(f"s{s}/mb{mb}" for s, mb, _ in path))
+    if result["suggestion"] is not None:
+        print(f"suggestion: {result['suggestion']['move']}, "
+              f"shifting about {result['suggestion']['target_shift']:.4f}s per micro-batch")
+
+
+if __name__=="__main__":
+    # timings dumped as JSON: a list with one list of records per stage
+    with open(sys.argv[1]) as f:
+        print_analysis(analyze(json.load(f)))
@@ -0,0 +1,173 @@
+import threading
+from collections import defaultdict
+
+import torch
+
+
+class Lease(object):
+    r"""
+    The set of pooled buffers handed out while one micro-batch runs through a
+    stage. Everything in the lease goes back to the pool when it is closed.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffers = []
+        self._closed = False
+
+    def keep(self, t):
+        r"""
+        Return a tensor that is safe to hand to the next stage. A pooled buffer
+        would be recycled as soon as the lease closes, so anything sharing
+        memory with one (the buffer itself or a view of it) is copied out.
+        """
+        if any(_overlaps(t, b) for b in self.buffers):
+            return t.clone()
+        return t
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for b in self.buffers:
+            self.pool.release(b)
+        self.buffers = []
+
+
+class BufferPool(object):
+    r"""
+    Recycle tensors of a given shape/dtype across micro-batches instead of
+    going back to the allocator for every layer output. With a fixed
+    micro-batch size every stage sees the same handful of shapes, so after the
+    first micro-batch almost every request is served from the free lists.
+
+    A stage's pool only serves ``StageBase.infer``: autograd keeps the
+    outputs it saved for backward and rejects ``out=`` kernels, so training
+    micro-batches run the regular kernels and open no lease, and the stage's
+    stats only count inference. The p2p transport keeps a pool of its own for
+    its receive buffers, released after the micro-batch's backward.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._free = defaultdict(list)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in_use = 0
+        self.bytes_pooled = 0
+        self.peak_bytes = 0
+
+    def acquire(self, shape, dtype=torch.float32):
+        key = (tuple(shape), dtype)
+        with self._lock:
+            free = self._free[key]
+            if free:
+                t = free.pop()
+                self.hits += 1
+                self.bytes_pooled -= _nbytes(t)
+            else:
+                t = None
+                self.misses += 1
+        if t is None:
+            t = torch.empty(key[0], dtype=dtype)
+        with self._lock:
+            self.bytes_in_use += _nbytes(t)
+            self.peak_bytes = max(self.peak_bytes, self.bytes_in_use + self.bytes_pooled)
+
+        lease = getattr(self._local, "lease", None)
+        if lease is not None:
+            lease.buffers.append(t)
+        return t
+
+    def release(self, t):
+        key = (tuple(t.shape), t.dtype)
+        with self._lock:
+            self._free[key].append(t)
+            self.bytes_in_use -= _nbytes(t)
+            self.bytes_pooled += _nbytes(t)
+
+    def lease(self):
+        r"""
+        Open a lease for the calling thread. Use as a context manager around a
+        stage forward; buffers acquired inside it are released on exit.
+        """
+        return _LeaseScope(self)
+
+    def linear(self, m, x):
+        r"""
+        Pooled replacement for ``nn.Linear.forward``. ``addmm`` can write into a
+        caller-provided tensor, but autograd does not support ``out=``, so while
+        a graph is being recorded this is the regular kernel.
+        """
+        if torch.is_grad_enabled() or getattr(self._local, "lease", None) is None:
+            return torch.nn.functional.linear(x, m.weight, m.bias)
+
+        out = self.acquire((x.size(0), m.out_features), x.dtype)
+        if m.bias is not None:
+            torch.addmm(m.bias, x, m.weight.t(), out=out)
+        else:
+            torch.mm(x, m.weight.t(), out=out)
+        return out
+
+    def install(self, module):
+        r"""
+        Route every ``nn.Linear`` under ``module`` through the pool.
+        """
+        for m in module.modules():
+            if isinstance(m, torch.nn.Linear):
+                m.forward = _bind(self.linear, m)
+
+    def uninstall(self, module):
+        r"""
+        Undo ``install`` for the Linear layers under ``module``, e.g. before
+        they move to another stage.
+        """
+        for m in module.modules():
+            if isinstance(m, torch.nn.Linear):
+                m.__dict__.pop("forward", None)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "bytes_in_use": self.bytes_in_use,
+                "bytes_pooled": self.bytes_pooled,
+                "peak_bytes": self.peak_bytes,
+            }
+
+
+class _LeaseScope(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.lease = None
+        self._prev = None
+
+    def __enter__(self):
+        self._prev = getattr(self.pool._local, "lease", None)
+        self.lease = Lease(self.pool)
+        self.pool._local.lease = self.lease
+        return self.lease
+
+    def __exit__(self, *exc):
+        self.pool._local.lease = self._prev
+        self.lease.close()
+        return False
+
+
+def _bind(fn, m):
+    def forward(x):
+        return fn(m, x)
+    return forward
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def _overlaps(t, b):
+    if t.numel() == 0 or b.numel() == 0:
+        return False
+    start = b.data_ptr()
+    return start <= t.data_ptr() < start + _nbytes(b)
@@ -0,0 +1,160 @@
+import glob
+import json
+import os
+import threading
+import time
+
+import torch
+
+
+class ShardWriter(object):
+    r"""
+    Worker side of checkpointing for one stage. ``save`` copies the stage's
+    parameters, buffers and (optionally) its worker's optimizer state under
+    the stage lock, then writes them to disk on a background thread, so the
+    pipeline only pauses for the in-memory copy.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def save(self, path, optim_rref=None):
+        with self.stage._lock, torch.no_grad():
+            state = {
+                "params": [p.detach().clone() for p in self.stage.parameters()],
+                "buffers": [b.detach().clone() for b in self.stage.buffers()],
+            }
+            if optim_rref is not None:
+                state["optim"] = _clone(optim_rref.local_value().optim.state_dict())
+
+        t = threading.Thread(target=self._write, args=(path, state), daemon=True)
+        with self._lock:
+            self._pending[path] = t
+        t.start()
+
+    def _write(self, path, state):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        torch.save(state, tmp)
+        os.replace(tmp, path)
+
+    def wait(self, path):
+        with self._lock:
+            t = self._pending.pop(path, None)
+        if t is not None:
+            t.join()
+        return path
+
+    def load(self, path, optim_rref=None):
+        state = torch.load(path)
+        self.stage._ready.wait()
+        with self.stage._lock, torch.no_grad():
+            for p, saved in zip(self.stage.parameters(), state["params"]):
+                p.copy_(saved)
+            for b, saved in zip(self.stage.buffers(), state["buffers"]):
+                b.copy_(saved)
+            if optim_rref is not None and "optim" in state:
+                optim_rref.local_value().optim.load_state_dict(state["optim"])
+
+
+class CheckpointManager(object):
+    r"""
+    Master side of checkpointing. Every stage writes its own shard
+    concurrently; once they have all landed, a manifest tying the shards to
+    the step is written next to them. A step's checkpoint only exists once
+    its manifest does.
+    """
+    def __init__(self, stage_rrefs, opt, ckpt_dir):
+        self.stage_rrefs = stage_rrefs
+        self.ckpt_dir = ckpt_dir
+        self._writers = []
+
+        # a worker has one local optimizer no matter how many stages it
+        # hosts; its state is saved with the first of them
+        optims = {o.owner().name: o for o in opt.remote_optimizers}
+        self.stage_optims = []
+        seen = set()
+        for s in stage_rrefs:
+            name = s.owner().name
+            self.stage_optims.append(optims.get(name) if name not in seen else None)
+            seen.add(name)
+
+    def _shard_paths(self, step):
+        return [
+            os.path.join(self.ckpt_dir, f"step{step}", f"stage{i}-{s.owner().name}.pt")
+            for i, s in enumerate(self.stage_rrefs)
+        ]
+
+    def save(self, step):
+        r"""
+        Snapshot every stage and return as soon as the copies are taken. Disk
+        writes and the manifest finish in the background.
+        """
+        paths = self._shard_paths(step)
+        torch.futures.wait_all([
+            s.rpc_async().save_shard(path, optim)
+            for s, path, optim in zip(self.stage_rrefs, paths, self.stage_optims)
+        ])
+
+        t = threading.Thread(target=self._finish, args=(step, paths), daemon=True)
+        self._writers.append(t)
+        t.start()
+
+    def _finish(self, step, paths):
+        torch.futures.wait_all([s.rpc_async().wait_shard(p) for s, p in zip(self.stage_rrefs, paths)])
+        manifest = {
+            "step": step,
+            "time": time.time(),
+            "shards": [
+                {"stage": i, "worker": s.owner().name, "path": p}
+                for i, (s, p) in enumerate(zip(self.stage_rrefs, paths))
+            ],
+        }
+        path = os.path.join(self.ckpt_dir, f"step{step}", "manifest.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def wait(self):
+        for t in self._writers:
+            t.join()
+        self._writers = []
+
+    def restore(self, manifest_path=None):
+        r"""
+        Load every shard onto its stage in parallel and return the step the
+        checkpoint was taken at. Defaults to the newest complete checkpoint.
+        """
+        if manifest_path is None:
+            manifest_path = latest_manifest(self.ckpt_dir)
+            if manifest_path is None:
+                return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if len(manifest["shards"]) != len(self.stage_rrefs):
+            raise ValueError(
+                f"checkpoint has {len(manifest['shards'])} shards, pipeline has {len(self.stage_rrefs)} stages"
+            )
+        torch.futures.wait_all([
+            s.rpc_async().load_shard(shard["path"], optim)
+            for s, shard, optim in zip(self.stage_rrefs, manifest["shards"], self.stage_optims)
+        ])
+        return manifest["step"]
+
+
+def latest_manifest(ckpt_dir):
+    manifests = glob.glob(os.path.join(ckpt_dir, "step*", "manifest.json"))
+    if not manifests:
+        return None
+    return max(manifests, key=lambda p: int(os.path.basename(os.path.dirname(p))[len("step"):]))
+
+
+def _clone(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {k: _clone(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_clone(v) for v in obj)
+    return obj
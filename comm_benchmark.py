@@ -0,0 +1,230 @@
+r"""
+How much one activation hop between stages costs. Two workers on separate
+cores exchange tensors over the TensorPipe RPC backend the way the pipeline
+does and the master times it:
+
+    pull      the receiver calls to_here() on an RRef owned by the sender
+              (what every stage does with its input)
+    send      the sender passes the tensor as an rpc_sync argument
+    remote    the sender passes it to rpc.remote and waits on the result RRef
+              (how DistPipeline chains one stage's output into the next)
+
+Each is measured for a range of activation shapes, ``num_worker_threads``
+settings and numbers of concurrent transfers. Per (threads, mode) a line
+``seconds = latency + bytes / bandwidth`` is fitted to the single-transfer
+times; the fit is saved as the cost model the partitioner reads.
+"""
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.distributed.rpc as rpc
+import torch.multiprocessing as mp
+
+
+# activation shapes that cross cuts in the templates, at split sizes 1 and 8
+shapes = [
+    (1, 1),
+    (1, 4096),
+    (8, 4096),
+    (1, 64, 31, 31),
+    (8, 64, 31, 31),
+    (1, 512, 16, 16),
+    (8, 512, 16, 16),
+    (8, 256, 64, 64),
+]
+worker_threads = [16, 256]
+concurrency = [1, 4, 16]
+warmup = 3
+repetitions = 20
+results_json = "comm_results.json"
+cost_model_json = "comm_model.json"
+
+
+#########################################################
+#                  Worker-side timing                   #
+#########################################################
+
+def _make(shape):
+    return torch.randn(*shape)
+
+
+def _consume(t):
+    return t.numel()
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _time_pull(rref, n=1):
+    times = []
+    for i in range(warmup + repetitions):
+        tik = time.perf_counter()
+        rref.to_here()
+        if i >= warmup:
+            times.append(time.perf_counter() - tik)
+    return _median(times)
+
+
+def _time_send(dst, shape, mode, n):
+    t = torch.randn(*shape)
+    times = []
+    for i in range(warmup + repetitions):
+        tik = time.perf_counter()
+        if mode == "send":
+            torch.futures.wait_all([rpc.rpc_async(dst, _consume, args=(t,)) for _ in range(n)])
+        else:
+            for r in [rpc.remote(dst, _consume, args=(t,)) for _ in range(n)]:
+                r.to_here()
+        if i >= warmup:
+            times.append(time.perf_counter() - tik)
+    return _median(times)
+
+
+def _pull_once(rref):
+    return rref.to_here().numel()
+
+
+def _time_pull_concurrent(rref, n):
+    # n stages pulling at once, each to_here on its own RPC thread
+    me = rpc.get_worker_info().name
+    times = []
+    for i in range(warmup + repetitions):
+        tik = time.perf_counter()
+        torch.futures.wait_all([rpc.rpc_async(me, _pull_once, args=(rref,)) for _ in range(n)])
+        if i >= warmup:
+            times.append(time.perf_counter() - tik)
+    return _median(times)
+
+
+#########################################################
+#                   Master / Processes                  #
+#########################################################
+
+def run_master(threads):
+    rows = []
+    for shape in shapes:
+        nbytes = 4 * int(torch.Size(shape).numel())
+        src = rpc.remote("worker1", _make, args=(shape,))
+        for n in concurrency:
+            timed = {
+                "pull": rpc.rpc_sync("worker2", _time_pull if n == 1 else _time_pull_concurrent, args=(src, n)),
+                "send": rpc.rpc_sync("worker1", _time_send, args=("worker2", shape, "send", n)),
+                "remote": rpc.rpc_sync("worker1", _time_send, args=("worker2", shape, "remote", n)),
+            }
+            for mode, seconds in timed.items():
+                rows.append({
+                    "threads": threads,
+                    "mode": mode,
+                    "concurrency": n,
+                    "shape": list(shape),
+                    "bytes": nbytes,
+                    "seconds": seconds,
+                    "bandwidth_MBps": n * nbytes / seconds / 1e6,
+                })
+    return rows
+
+
+def run_worker(rank, world_size, threads, results):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=threads, rpc_timeout=600)
+
+    import psutil
+    ncores = os.cpu_count()
+    psutil.Process().cpu_affinity([rank % ncores])
+    torch.set_num_threads(1)
+
+    if rank == 0:
+        rpc.init_rpc("master", rank=rank, world_size=world_size, rpc_backend_options=options)
+        results.put(run_master(threads))
+    else:
+        rpc.init_rpc(f"worker{rank}", rank=rank, world_size=world_size, rpc_backend_options=options)
+
+    # block until all rpcs finish
+    rpc.shutdown()
+
+
+#########################################################
+#                       Cost model                      #
+#########################################################
+
+def fit(rows):
+    r"""
+    Least-squares ``seconds = latency + bytes / bandwidth`` over the
+    single-transfer rows, per (threads, mode).
+    """
+    groups = {}
+    for r in rows:
+        if r["concurrency"] == 1:
+            groups.setdefault((r["threads"], r["mode"]), []).append((r["bytes"], r["seconds"]))
+
+    model = {}
+    for (threads, mode), points in groups.items():
+        n = len(points)
+        mean_b = sum(b for b, _ in points) / n
+        mean_t = sum(t for _, t in points) / n
+        var = sum((b - mean_b) ** 2 for b, _ in points)
+        slope = sum((b - mean_b) * (t - mean_t) for b, t in points) / var if var else 0.0
+        latency = max(mean_t - slope * mean_b, 0.0)
+        model.setdefault(str(threads), {})[mode] = {
+            "latency_ms": 1000 * latency,
+            "bandwidth_MBps": 1 / slope / 1e6 if slope > 0 else float("inf"),
+        }
+    return model
+
+
+def load_cost_model(path=cost_model_json, threads=256):
+    with open(path) as f:
+        return json.load(f)[str(threads)]
+
+
+def transfer_ms(cost_model, nbytes, mode="pull"):
+    r"""
+    Predicted time for one hop of ``nbytes``, with the share of it that is
+    fixed per-message latency.
+    """
+    c = cost_model[mode]
+    ms = c["latency_ms"] + 1000 * nbytes / (c["bandwidth_MBps"] * 1e6)
+    return ms, c["latency_ms"] / ms if ms else 0.0
+
+
+def print_results(rows, model):
+    print(f"{'threads':>8} {'mode':<8}{'conc':>5} {'shape':<18}{'KB':>10}{'ms':>10}{'MB/s':>10}")
+    for r in rows:
+        shape = "x".join(str(s) for s in r["shape"])
+        print(f"{r['threads']:>8} {r['mode']:<8}{r['concurrency']:>5} {shape:<18}{r['bytes'] / 1024:>10.1f}"
+              f"{1000 * r['seconds']:>10.3f}{r['bandwidth_MBps']:>10.1f}")
+    print()
+    for threads, modes in model.items():
+        for mode, c in modes.items():
+            print(f"threads={threads} {mode}: latency {c['latency_ms']:.3f} ms, bandwidth {c['bandwidth_MBps']:.1f} MB/s")
+            for shape in (shapes[3], shapes[5]):
+                ms, share = transfer_ms(modes, 4 * int(torch.Size(shape).numel()), mode)
+                bound = "latency" if share > 0.5 else "bandwidth"
+                print(f"    {'x'.join(str(s) for s in shape)}: {ms:.3f} ms, {bound} bound ({100 * share:.0f}% latency)")
+
+
+if __name__=="__main__":
+    if len(sys.argv) > 1:
+        # re-fit a previous run
+        with open(sys.argv[1]) as f:
+            rows = json.load(f)
+    else:
+        rows = []
+        for threads in worker_threads:
+            ctx = mp.get_context("spawn")
+            results = ctx.SimpleQueue()
+            mp.spawn(run_worker, args=(3, threads, results), nprocs=3, join=True)
+            rows.extend(results.get())
+        with open(results_json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+    model = fit(rows)
+    print_results(rows, model)
+    with open(cost_model_json, "w") as f:
+        json.dump(model, f, indent=2)
@@ -0,0 +1,122 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed.autograd as dist_autograd
+import torch.distributed.rpc as rpc
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.distributed.optim import DistributedOptimizer
+
+from fx_split import DistFxPipeline
+from model_layers import build_layers, num_layers
+from placement import plan_placement, print_plan, rank_cpus, validate_plan
+
+num_classes = 1000
+
+
+#########################################################
+#                   Run RPC Processes                   #
+#########################################################
+
+num_stages = 4
+num_batches = 1
+batch_size = 128
+image_w = 256
+image_h = 256
+
+# the node names that start stages 1, 2, ...; None cuts by parameter count
+cuts = None
+
+
+def build_model():
+    # any torch.fx-traceable module works here, e.g. a torchvision model;
+    # ResNet's residual adds are traced through, so cuts may fall inside a
+    # block and the skip connection is carried across the cut
+    kwargs = dict(image_w=image_w, image_h=image_h, num_classes=num_classes)
+    return nn.Sequential(*build_layers("resnet", 0, num_layers("resnet", **kwargs), **kwargs))
+
+
+def run_master(split_size, workers):
+
+    model = DistFxPipeline(build_model(), split_size, workers, num_stages, cuts)
+    loss_fn = nn.MSELoss()
+    opt = DistributedOptimizer(
+        optim.SGD,
+        model.parameter_rrefs(),
+        lr=0.05,
+    )
+    model.wait_ready()
+
+    one_hot_indices = torch.LongTensor(batch_size) \
+                           .random_(0, num_classes) \
+                           .view(batch_size, 1)
+
+    for i in range(num_batches):
+        print(f"Processing batch {i}")
+        # generate random inputs and labels
+        inputs = torch.randn(batch_size, 3, image_w, image_h)
+        labels = torch.zeros(batch_size, num_classes) \
+                      .scatter_(1, one_hot_indices, 1)
+
+        with dist_autograd.context() as context_id:
+            outputs = model(inputs)
+            dist_autograd.backward(context_id, [loss_fn(outputs, labels)])
+            opt.step(context_id)
+
+
+def run_worker(rank, world_size, split_size, plan):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=256, rpc_timeout=600)
+
+    import psutil
+    p = psutil.Process()
+
+    if rank == 0:
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
+
+        rpc.init_rpc(
+            "master",
+            rank=rank,
+            world_size=world_size,
+            rpc_backend_options=options
+        )
+        run_master(split_size, [f"worker{r}" for r in range(1, world_size)])
+    else:
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
+
+        rpc.init_rpc(
+            f"worker{rank}",
+            rank=rank,
+            world_size=world_size,
+            rpc_backend_options=options
+        )
+
+    # block until all rpcs finish
+    rpc.shutdown()
+
+
+if __name__=="__main__":
+    # the master plus one worker per stage
+    world_size = num_stages + 1
+    # give the master and every worker their own cores, checked before spawning
+    plan = plan_placement(world_size - 1)
+    try:
+        print_plan(plan, warnings=validate_plan(plan))
+    except ValueError as e:
+        # too few CPUs for one per rank: run unpinned rather than not at all
+        print(f"placement: {e}, running without CPU affinity")
+        plan = None
+    for split_size in [4, 8]:
+        tik = time.time()
+        mp.spawn(run_worker, args=(world_size, split_size, plan), nprocs=world_size, join=True)
+        tok = time.time()
+        print(f"execution time = {tok - tik}")
@@ -0,0 +1,164 @@
+r"""
+Pipeline stages cut automatically out of any traceable nn.Module.
+
+The module is traced with torch.fx and every node is assigned to a stage by
+cut points (the names of the nodes that start stages 1, 2, ...);
+torch.fx's split_module then turns each stage into a submodule. Values that
+a later stage needs, skip connections included, become extra outputs of the
+stage that produces them.
+
+Between stages the pipeline passes an environment: a dict from node name
+(in the split graph) to tensor, holding everything a later stage still
+reads. The first stage takes the plain input tensor and the last returns
+the plain output, so FxStages drop into DistPipeline unchanged.
+"""
+import operator
+
+import torch
+import torch.fx
+from torch.fx.passes.split_module import split_module
+
+from pipeline import DistPipeline
+from stage_base import StageBase
+
+
+def _compute_nodes(gm):
+    return [n for n in gm.graph.nodes if n.op in ("call_module", "call_function", "call_method")]
+
+
+def even_node_cuts(gm, num_stages):
+    r"""
+    Cut points that give every stage roughly the same number of parameters,
+    falling back to the same number of operations for parameter-free graphs.
+    """
+    nodes = _compute_nodes(gm)
+    modules = dict(gm.named_modules())
+    weights = [
+        sum(p.numel() for p in modules[n.target].parameters()) if n.op == "call_module" else 0
+        for n in nodes
+    ]
+    if sum(weights) == 0:
+        weights = [1] * len(nodes)
+    total = sum(weights)
+    cuts = []
+    acc = 0
+    for n, w in zip(nodes, weights):
+        if len(cuts) < num_stages - 1 and acc >= total * (len(cuts) + 1) / num_stages:
+            cuts.append(n.name)
+        acc += w
+    if len(cuts) != num_stages - 1:
+        raise ValueError(f"cannot cut {len(nodes)} operations into {num_stages} stages")
+    return cuts
+
+
+def split_stages(module, cuts):
+    r"""
+    Trace ``module`` and split it at ``cuts``. Returns one stage spec per
+    stage: the submodule, the environment keys it reads, the keys it
+    produces, the keys it passes on, and (for the last stage) the key of
+    the model output.
+    """
+    gm = module if isinstance(module, torch.fx.GraphModule) else torch.fx.symbolic_trace(module)
+    names = {n.name for n in gm.graph.nodes}
+    for c in cuts:
+        if c not in names:
+            raise ValueError(f"cut point {c!r} is not a node of the traced graph")
+
+    partition = {}
+    stage = 0
+    for n in gm.graph.nodes:
+        if n.name in cuts:
+            stage += 1
+        partition[n.name] = stage
+    split = split_module(gm, gm, lambda n: partition[n.name])
+
+    calls = {n.target: n for n in split.graph.nodes if n.op == "call_module"}
+    output = next(n for n in split.graph.nodes if n.op == "output")
+    num_stages = len(calls)
+
+    specs = []
+    for i in range(num_stages):
+        call = calls[f"submod_{i}"]
+        getitems = sorted(
+            (u.args[1], u.name) for u in call.users
+            if u.op == "call_function" and u.target is operator.getitem
+        )
+        out_keys = [name for _, name in getitems] if getitems else [call.name]
+        specs.append({
+            "submodule": getattr(split, f"submod_{i}"),
+            "in_keys": [a.name for a in call.args],
+            "out_keys": out_keys,
+            "multi_output": bool(getitems),
+        })
+
+    # a key stays live after stage i if a later stage, or the output, reads it
+    later = set()
+    result = output.args[0]
+    later.add(result.name)
+    for i in reversed(range(num_stages)):
+        spec = specs[i]
+        spec["live_keys"] = sorted(later)
+        later.difference_update(spec["out_keys"])
+        later.update(spec["in_keys"])
+    specs[-1]["result_key"] = result.name
+    return specs
+
+
+class FxStage(StageBase):
+    r"""
+    One stage cut out of a traced model. Its weights arrive with the
+    submodule, so there is nothing to initialise.
+    """
+    def __init__(self, submodule, in_keys, out_keys, multi_output, live_keys, result_key=None,
+                 prefetch_depth=None, await_snapshot=False):
+        super(FxStage, self).__init__(prefetch_depth, await_snapshot)
+        self.submodule = submodule
+        self.in_keys = in_keys
+        self.out_keys = out_keys
+        self.multi_output = multi_output
+        self.live_keys = live_keys
+        self.result_key = result_key
+        self.finish_init()
+
+    def _materialize(self):
+        self._ready.set()
+
+    def forward(self, x_rref, mb=None):
+        env = self.receive(x_rref, mb)
+        if not isinstance(env, dict):
+            env = {self.in_keys[0]: env}
+
+        with self.micro_batch(env[self.in_keys[0]]) as scope:
+            out = self.submodule(*[env[k] for k in self.in_keys])
+            outs = list(out) if self.multi_output else [out]
+            outs = [scope.keep(outs[0])] + [scope.copy_out(o) for o in outs[1:]]
+        env.update(zip(self.out_keys, outs))
+
+        if self.result_key is not None:
+            return env[self.result_key]
+        return {k: env[k] for k in self.live_keys}
+
+
+class DistFxPipeline(DistPipeline):
+    r"""
+    ``module`` traced and cut into ``num_stages`` FxStages, at ``cuts`` if
+    given and by parameter count otherwise. Weights travel with the stages,
+    so there is no snapshot to await.
+    """
+    def __init__(self, module, split_size, workers, num_stages=None, cuts=None, prefetch_depth=None,
+                 max_in_flight=None):
+        if cuts is None:
+            num_stages = num_stages or len(workers)
+            cuts = even_node_cuts(torch.fx.symbolic_trace(module), num_stages)
+        specs = split_stages(module, cuts)
+        super(DistFxPipeline, self).__init__(
+            split_size,
+            workers,
+            [
+                (FxStage, (s["submodule"], s["in_keys"], s["out_keys"], s["multi_output"],
+                           s["live_keys"], s.get("result_key")), {})
+                for s in specs
+            ],
+            prefetch_depth,
+            max_in_flight=max_in_flight
+        )
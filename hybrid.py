@@ -0,0 +1,165 @@
+r"""
+Data parallelism across whole pipelines. ``num_replicas`` copies of the same
+pipeline each run a shard of the global batch; afterwards the gradients of
+corresponding stages are summed across the replicas with a gloo all-reduce,
+so every replica's optimizer takes the same step and the copies stay equal.
+
+Every RPC process also joins a gloo process group. Stage ``s`` of replica
+``r`` lives on worker ``1 + r * num_stages + s``, and the workers holding
+stage ``s`` of every replica form one sub-group.
+"""
+import threading
+
+import torch
+import torch.distributed as dist
+import torch.distributed.autograd as dist_autograd
+import torch.nn as nn
+
+
+# this process's stage group and the rank that broadcasts into it
+_group = None
+_src = None
+
+
+def replica_workers(workers, num_replicas):
+    r"""
+    Split the worker names into ``num_replicas`` consecutive runs, one per
+    pipeline replica.
+    """
+    if len(workers) % num_replicas != 0:
+        raise ValueError(f"{len(workers)} workers cannot hold {num_replicas} equal replicas")
+    n = len(workers) // num_replicas
+    return [workers[r * n:(r + 1) * n] for r in range(num_replicas)]
+
+
+def init_replica_groups(rank, world_size, num_replicas, port=29501):
+    r"""
+    Join the gloo group and build one sub-group per stage. Every process,
+    master included, has to call this, since creating a group is collective.
+    """
+    global _group, _src
+    num_stages = (world_size - 1) // num_replicas
+    if not dist.is_initialized():
+        dist.init_process_group(
+            "gloo",
+            init_method=f"tcp://localhost:{port}",
+            rank=rank,
+            world_size=world_size
+        )
+    for s in range(num_stages):
+        ranks = [1 + r * num_stages + s for r in range(num_replicas)]
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            _group, _src = group, ranks[0]
+
+
+def broadcast_module(module):
+    r"""
+    Copy replica 0's parameters and buffers into this stage.
+    """
+    if _group is None:
+        return
+    with torch.no_grad():
+        for t in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(t.data, src=_src, group=_group)
+
+
+def allreduce_gradients(module, context_id):
+    r"""
+    Sum this stage's gradients in ``context_id`` across the replicas. The
+    gradients are flattened into one buffer for a single collective and
+    copied back into the tensors the context holds, which is what the
+    DistributedOptimizer step reads.
+    """
+    if _group is None:
+        return
+    grads = dist_autograd.get_gradients(context_id)
+    params = list(module.parameters())
+    flat = torch.cat([
+        grads[p].reshape(-1) if p in grads else torch.zeros(p.numel(), dtype=p.dtype)
+        for p in params
+    ])
+    dist.all_reduce(flat, group=_group)
+    offset = 0
+    for p in params:
+        if p in grads:
+            grads[p].copy_(flat[offset:offset + p.numel()].view_as(grads[p]))
+        offset += p.numel()
+
+
+class HybridPipeline(nn.Module):
+    r"""
+    Several replicas of one DistPipeline. ``forward`` shards the batch across
+    the replicas and runs them concurrently; since the loss is taken over the
+    concatenated output, summing the replicas' gradients gives the gradient
+    of the whole batch.
+    """
+    def __init__(self, replicas):
+        super(HybridPipeline, self).__init__()
+        self.replicas = replicas
+        self.split_size = replicas[0].split_size
+
+    def forward(self, xs):
+        shards = xs.tensor_split(len(self.replicas), dim=0)
+        issuers = [p.issue(x) for p, x in zip(self.replicas, shards)]
+        # send to every replica that has a free credit, and only wait when
+        # none has, until a micro-batch of any replica comes out; a replica
+        # out of credits does not hold back the others
+        progress = threading.Event()
+        pending = list(issuers)
+        while pending:
+            sent = False
+            for issuer in list(pending):
+                if issuer.done():
+                    pending.remove(issuer)
+                elif issuer.ready():
+                    issuer.send_next().then(lambda fut: progress.set())
+                    sent = True
+            if pending and not sent:
+                progress.wait()
+                progress.clear()
+        return torch.cat([torch.cat(torch.futures.wait_all(i.futures)) for i in issuers])
+
+    def stage_rrefs(self):
+        return [s for p in self.replicas for s in p.stage_rrefs()]
+
+    def wait_ready(self):
+        # replica 0 initialises (or maps a snapshot); the rest copy it
+        self.replicas[0].wait_ready()
+        self.sync_replicas()
+
+    def sync_replicas(self):
+        if len(self.replicas) > 1:
+            torch.futures.wait_all([s.rpc_async().broadcast_parameters() for s in self.stage_rrefs()])
+
+    def allreduce_gradients(self, context_id):
+        if len(self.replicas) > 1:
+            torch.futures.wait_all([
+                s.rpc_async().allreduce_gradients(context_id) for s in self.stage_rrefs()
+            ])
+
+    def parameter_rrefs(self):
+        remote_params = []
+        for p in self.replicas:
+            remote_params.extend(p.parameter_rrefs())
+        return remote_params
+
+    def timings(self):
+        r"""
+        One list of stage timings per replica; the analyzer looks at one
+        pipeline at a time.
+        """
+        return [p.timings() for p in self.replicas]
+
+    def cpu_times(self):
+        return [t for p in self.replicas for t in p.cpu_times()]
+
+    def buffer_stats(self):
+        return [s for p in self.replicas for s in p.buffer_stats()]
+
+    def memory_begin(self):
+        for p in self.replicas:
+            p.memory_begin()
+
+    def memory_reports(self):
+        return [r for p in self.replicas for r in p.memory_reports()]
@@ -0,0 +1,174 @@
+import queue
+import random
+import threading
+import time
+
+import torch
+from torch.distributed.rpc import RRef
+
+
+class Request(object):
+    def __init__(self, x):
+        self.x = x
+        self.arrival = time.time()
+        self.future = torch.futures.Future()
+        self.done = None
+
+
+class InferencePipeline(object):
+    r"""
+    Serve single requests through the pipeline stages without autograd.
+
+    Requests are queued and grouped into micro-batches on the fly: a batch is
+    sent as soon as ``max_batch_size`` requests are waiting or the oldest one
+    has waited ``max_wait`` seconds. Batches are chained through the stages
+    with the same ``remote()`` pattern as training, so several batches can be
+    in the pipeline at once, and each request's future completes as soon as
+    its batch leaves the last stage.
+    """
+    def __init__(self, stage_rrefs, max_batch_size=8, max_wait=0.005):
+        self.stage_rrefs = stage_rrefs
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = []
+        self._error = None
+        self.latencies = []
+        self.batch_sizes = []
+
+        torch.futures.wait_all([s.rpc_async().set_training(False) for s in self.stage_rrefs])
+        self._batcher = threading.Thread(target=self._run, daemon=True)
+        self._batcher.start()
+
+    def submit(self, x):
+        r"""
+        Queue one sample (without the batch dimension) and return a future for
+        its output.
+        """
+        req = Request(x)
+        if self._error is not None:
+            req.future.set_exception(self._error)
+            return req.future
+        self._queue.put(req)
+        return req.future
+
+    def close(self):
+        self._stopped.set()
+        self._batcher.join()
+        with self._lock:
+            pending = list(self._in_flight)
+        torch.futures.wait_all(pending)
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=0.05)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            batch = []
+            try:
+                batch = self._next_batch()
+                if batch:
+                    self.dispatch(batch)
+            except Exception as e:
+                self._fail(batch, e)
+                return
+
+    def _fail(self, batch, e):
+        r"""
+        The batcher cannot go on: fail the batch it was holding, everything
+        still queued, and every later ``submit``, instead of leaving their
+        futures waiting forever.
+        """
+        self._error = RuntimeError(f"inference batcher stopped: {e!r}")
+        pending = list(batch)
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for r in pending:
+            if not r.future.done():
+                r.future.set_exception(self._error)
+
+    def dispatch(self, batch):
+        xs = torch.stack([r.x for r in batch])
+        rref = RRef(xs)
+        for stage in self.stage_rrefs[:-1]:
+            rref = stage.remote().infer(rref)
+        fut = self.stage_rrefs[-1].rpc_async().infer(rref)
+
+        def _scatter(f):
+            try:
+                outs = f.wait()
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                return
+            now = time.time()
+            with self._lock:
+                self.batch_sizes.append(len(batch))
+                for r, out in zip(batch, outs):
+                    r.done = now
+                    self.latencies.append(now - r.arrival)
+            for r, out in zip(batch, outs):
+                r.future.set_result(out)
+
+        done = fut.then(_scatter)
+        with self._lock:
+            self._in_flight = [f for f in self._in_flight if not f.done()]
+            self._in_flight.append(done)
+        return done
+
+    def stats(self):
+        with self._lock:
+            lat = sorted(self.latencies)
+            sizes = list(self.batch_sizes)
+        if not lat:
+            return {"requests": 0}
+        return {
+            "requests": len(lat),
+            "p50": _percentile(lat, 0.50),
+            "p99": _percentile(lat, 0.99),
+            "max": lat[-1],
+            "mean_batch_size": sum(sizes) / len(sizes),
+        }
+
+
+def serve_benchmark(pipeline, sample_shape, num_requests, rate):
+    r"""
+    Drive ``pipeline`` with ``num_requests`` Poisson arrivals at ``rate``
+    requests per second, wait for every result and report latency and
+    throughput.
+    """
+    futures = []
+    tik = time.time()
+    for _ in range(num_requests):
+        futures.append(pipeline.submit(torch.randn(*sample_shape)))
+        time.sleep(random.expovariate(rate))
+    torch.futures.wait_all(futures)
+    tok = time.time()
+
+    stats = pipeline.stats()
+    stats["throughput"] = num_requests / (tok - tik)
+    return stats
+
+
+def _percentile(sorted_values, q):
+    idx = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[idx]
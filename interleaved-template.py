@@ -0,0 +1,105 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed.rpc as rpc
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from interleaved import DistInterleavedNet
+from placement import plan_placement, print_plan, rank_cpus, validate_plan
+from schedule import ScheduledPipeline
+
+num_classes = 1000
+
+
+#########################################################
+#                   Run RPC Processes                   #
+#########################################################
+
+model_name = "alexnet"
+num_chunks = 8
+num_batches = 1
+batch_size = 128
+image_w = 128
+image_h = 128
+
+
+def run_master(split_size, workers):
+
+    # spread num_chunks virtual stages round-robin over the workers
+    model = DistInterleavedNet(model_name, split_size, workers, num_chunks,
+                               image_w=image_w, image_h=image_h, num_classes=num_classes)
+    # every worker runs its chunks' forwards and backwards in interleaved
+    # 1F1B order and steps a local optimizer over their parameters
+    trainer = ScheduledPipeline(model, "interleaved", optim.SGD, nn.MSELoss(), lr=0.05)
+    model.wait_ready()
+
+    one_hot_indices = torch.LongTensor(batch_size) \
+                           .random_(0, num_classes) \
+                           .view(batch_size, 1)
+
+    for i in range(num_batches):
+        print(f"Processing batch {i}")
+        # generate random inputs and labels
+        inputs = torch.randn(batch_size, 3, image_w, image_h)
+        labels = torch.zeros(batch_size, num_classes) \
+                      .scatter_(1, one_hot_indices, 1)
+
+        print(f"interleaved loss: {trainer.train_step(inputs, labels)}")
+
+
+def run_worker(rank, world_size, split_size, plan):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=256, rpc_timeout=600)
+
+    import psutil
+    p = psutil.Process()
+
+    if rank == 0:
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
+
+        rpc.init_rpc(
+            "master",
+            rank=rank,
+            world_size=world_size,
+            rpc_backend_options=options
+        )
+        run_master(split_size, [f"worker{r}" for r in range(1, world_size)])
+    else:
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
+
+        rpc.init_rpc(
+            f"worker{rank}",
+            rank=rank,
+            world_size=world_size,
+            rpc_backend_options=options
+        )
+
+    # block until all rpcs finish
+    rpc.shutdown()
+
+
+if __name__=="__main__":
+    world_size = 5
+    # give the master and every worker their own cores, checked before spawning
+    plan = plan_placement(world_size - 1)
+    try:
+        print_plan(plan, warnings=validate_plan(plan))
+    except ValueError as e:
+        # too few CPUs for one per rank: run unpinned rather than not at all
+        print(f"placement: {e}, running without CPU affinity")
+        plan = None
+    for split_size in [4, 8, 16]:
+        tik = time.time()
+        mp.spawn(run_worker, args=(world_size, split_size, plan), nprocs=world_size, join=True)
+        tok = time.time()
+        print(f"execution time = {tok - tik}")
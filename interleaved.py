@@ -0,0 +1,19 @@
+from pipeline import DistLayerPipeline
+
+
+class DistInterleavedNet(DistLayerPipeline):
+    r"""
+    Pipeline with ``num_chunks`` virtual stages placed round-robin over the
+    workers, so each worker holds several non-contiguous chunks of the model.
+    Every micro-batch visits the chunks in model order and so passes each
+    worker several times. Train it with ``ScheduledPipeline(..., "interleaved")``
+    to run the interleaved 1F1B order, backward included.
+    """
+    def __init__(self, model_name, split_size, workers, num_chunks, cuts=None,
+                 prefetch_depth=None, await_snapshot=False, max_in_flight=None, **model_kwargs):
+        if num_chunks % len(workers) != 0:
+            raise ValueError(f"{num_chunks} chunks cannot be spread evenly over {len(workers)} workers")
+        super(DistInterleavedNet, self).__init__(model_name, split_size, workers, num_chunks, cuts,
+                                                 prefetch_depth, await_snapshot, max_in_flight, **model_kwargs)
+
+        self.chunks_per_worker = num_chunks // len(workers)
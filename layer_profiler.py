@@ -0,0 +1,256 @@
+r"""
+Per-layer cost table for the models in model_layers, measured on one pinned
+core the way a pipeline stage runs them.
+
+Every layer is timed on its own (forward, then backward from a random output
+gradient) on the real output of the layer before it, after ``warmup``
+untimed passes; the median of ``repetitions`` passes is kept. A partition's
+stages can then be timed whole to see how far the per-layer sums are off
+(cache reuse between layers, allocator effects).
+
+The table is a list of dicts, one per layer in pipeline order, saved as JSON
+(and CSV for a spreadsheet). Times are in ms, sizes in bytes.
+"""
+import csv
+import json
+import os
+import sys
+import time
+
+import torch
+
+from model_layers import KAIMING_INIT, build_layers, even_cuts, initialize_weights, num_layers
+
+
+models = {
+    "alexnet": (128, 128),
+    "vgg": (128, 128),
+    "resnet": (256, 256),
+}
+num_classes = 1000
+micro_batch_size = 8
+warmup = 2
+repetitions = 5
+core = 0
+output_dir = "costs"
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _out_of_place(module):
+    # an in-place ReLU on the leaf input would fail in backward
+    for m in module.modules():
+        if getattr(m, "inplace", False):
+            m.inplace = False
+
+
+def time_module(module, x):
+    r"""
+    Median forward and backward seconds of ``module`` on input ``x``, and the
+    output of the last pass.
+    """
+    forward_times = []
+    backward_times = []
+    for i in range(warmup + repetitions):
+        inp = x.detach().requires_grad_(True)
+        module.zero_grad(set_to_none=True)
+
+        tik = time.perf_counter()
+        out = module(inp)
+        tok = time.perf_counter()
+        grad = torch.randn_like(out)
+        tik2 = time.perf_counter()
+        out.backward(grad)
+        tok2 = time.perf_counter()
+
+        if i >= warmup:
+            forward_times.append(tok - tik)
+            backward_times.append(tok2 - tik2)
+    return _median(forward_times), _median(backward_times), out.detach()
+
+
+def saved_bytes(module, x):
+    r"""
+    Bytes autograd keeps alive between forward and backward for one pass,
+    not counting the module's own parameters.
+    """
+    params = {p.data_ptr() for p in module.parameters()}
+    saved = {}
+
+    def pack(t):
+        if t.data_ptr() not in params:
+            saved[t.data_ptr()] = _nbytes(t)
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        module(x.detach().requires_grad_(True))
+    return sum(saved.values())
+
+
+def build_model(model_name, image_w, image_h):
+    kwargs = dict(image_w=image_w, image_h=image_h, num_classes=num_classes)
+    layers = build_layers(model_name, 0, num_layers(model_name, **kwargs), **kwargs)
+    for layer in layers:
+        if model_name in KAIMING_INIT:
+            initialize_weights(layer)
+        _out_of_place(layer)
+        layer.train()
+    return layers
+
+
+def profile_layers(model_name, image_w, image_h, layers=None):
+    r"""
+    Cost table for ``model_name``: one row per layer with forward and
+    backward ms, parameter bytes, output activation bytes (what crosses a cut
+    placed after the layer) and saved bytes (what the layer holds per
+    in-flight micro-batch).
+    """
+    if layers is None:
+        layers = build_model(model_name, image_w, image_h)
+    rows = []
+    x = torch.randn(micro_batch_size, 3, image_w, image_h)
+    for i, layer in enumerate(layers):
+        forward_s, backward_s, out = time_module(layer, x)
+        rows.append({
+            "model": model_name,
+            "index": i,
+            "layer": type(layer).__name__,
+            "micro_batch_size": micro_batch_size,
+            "input_shape": list(x.shape),
+            "output_shape": list(out.shape),
+            "forward_ms": 1000 * forward_s,
+            "backward_ms": 1000 * backward_s,
+            "param_bytes": sum(_nbytes(p) for p in layer.parameters()),
+            "activation_bytes": _nbytes(out),
+            "saved_bytes": saved_bytes(layer, x),
+        })
+        x = out
+    return rows
+
+
+def stage_costs(rows, cuts):
+    r"""
+    Per-stage totals of the cost table for a partition given as (start, end)
+    layer ranges. ``boundary_bytes`` is the activation the stage sends on.
+    """
+    stages = []
+    for start, end in cuts:
+        part = rows[start:end]
+        stages.append({
+            "start": start,
+            "end": end,
+            "forward_ms": sum(r["forward_ms"] for r in part),
+            "backward_ms": sum(r["backward_ms"] for r in part),
+            "param_bytes": sum(r["param_bytes"] for r in part),
+            "saved_bytes": sum(r["saved_bytes"] for r in part),
+            "boundary_bytes": part[-1]["activation_bytes"] if part else 0,
+        })
+    return stages
+
+
+def profile_stages(rows, cuts, layers):
+    r"""
+    Time each stage of the partition as one Sequential, the way LayerStage
+    runs it, next to the sum of its layers measured in isolation.
+    """
+    stages = stage_costs(rows, cuts)
+    for stage in stages:
+        start, end = stage["start"], stage["end"]
+        x = torch.randn(*rows[start]["input_shape"])
+        forward_s, backward_s, _ = time_module(torch.nn.Sequential(*layers[start:end]), x)
+        stage["measured_forward_ms"] = 1000 * forward_s
+        stage["measured_backward_ms"] = 1000 * backward_s
+    return stages
+
+
+def layers_to_move(rows, cuts, suggestion):
+    r"""
+    Turn a bubble_analyzer suggestion into concrete layers: the layers at the
+    bottleneck's edge facing its neighbour whose forward cost adds up closest
+    to ``target_shift``. Returns the layer indices and the new cuts.
+    """
+    if suggestion is None:
+        return [], list(cuts)
+    b, n = suggestion["bottleneck"], suggestion["neighbour"]
+    start, end = cuts[b]
+    edge = range(start, end - 1) if n < b else range(end - 1, start, -1)
+    target_ms = 1000 * suggestion["target_shift"]
+
+    moved = []
+    total = 0.0
+    for i in edge:
+        cost = rows[i]["forward_ms"]
+        if abs(total + cost - target_ms) > abs(total - target_ms):
+            break
+        moved.append(i)
+        total += cost
+
+    new_cuts = list(cuts)
+    if moved:
+        if n < b:
+            new_cuts[n] = (cuts[n][0], moved[-1] + 1)
+            new_cuts[b] = (moved[-1] + 1, end)
+        else:
+            new_cuts[b] = (start, moved[-1])
+            new_cuts[n] = (moved[-1], cuts[n][1])
+    return moved, new_cuts
+
+
+def save_cost_table(rows, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(rows, f, indent=2)
+    with open(os.path.splitext(path)[0] + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def load_cost_table(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_cost_table(rows):
+    mb = 1024 * 1024
+    print(f"{'#':>3} {'layer':<12}{'fwd ms':>9}{'bwd ms':>9}{'params MB':>11}{'out MB':>9}{'saved MB':>10}")
+    for r in rows:
+        print(f"{r['index']:>3} {r['layer']:<12}{r['forward_ms']:>9.2f}{r['backward_ms']:>9.2f}"
+              f"{r['param_bytes'] / mb:>11.2f}{r['activation_bytes'] / mb:>9.2f}{r['saved_bytes'] / mb:>10.2f}")
+
+
+def print_stage_costs(stages):
+    print(f"{'stage':<7}{'layers':>9}{'fwd ms':>9}{'(run)':>9}{'bwd ms':>9}{'(run)':>9}")
+    for i, s in enumerate(stages):
+        print(f"{i:<7}{s['start']:>4}-{s['end']:<4}{s['forward_ms']:>9.2f}{s.get('measured_forward_ms', 0):>9.2f}"
+              f"{s['backward_ms']:>9.2f}{s.get('measured_backward_ms', 0):>9.2f}")
+
+
+if __name__=="__main__":
+    # python layer_profiler.py [model ...] [--stages N]
+    import psutil
+    psutil.Process().cpu_affinity([core])
+    torch.set_num_threads(1)
+
+    args = sys.argv[1:]
+    num_stages = 4
+    if "--stages" in args:
+        i = args.index("--stages")
+        num_stages = int(args[i + 1])
+        del args[i:i + 2]
+
+    for model_name in args or list(models):
+        image_w, image_h = models[model_name]
+        print(f"## {model_name} (micro-batch {micro_batch_size}, {image_w}x{image_h})")
+        layers = build_model(model_name, image_w, image_h)
+        rows = profile_layers(model_name, image_w, image_h, layers)
+        print_cost_table(rows)
+        print_stage_costs(profile_stages(rows, even_cuts(len(rows), num_stages), layers))
+        save_cost_table(rows, os.path.join(output_dir, f"{model_name}-mb{micro_batch_size}.json"))
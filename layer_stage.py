@@ -0,0 +1,98 @@
+import time
+
+import torch
+
+from model_layers import KAIMING_INIT, build_layers, initialize_weights
+from stage_base import StageBase
+
+
+class LayerStage(StageBase):
+    r"""
+    A pipeline stage holding layers [start, end) of one of the models in
+    model_layers. ``chunk_id`` is the stage's position in the whole pipeline;
+    with interleaving several chunks live on the same worker.
+    """
+    def __init__(self, model_name, start, end, chunk_id=0, prefetch_depth=None, await_snapshot=False,
+                 **model_kwargs):
+        super(LayerStage, self).__init__(prefetch_depth, await_snapshot)
+        self.model_name = model_name
+        self.start = start
+        self.end = end
+        self.chunk_id = chunk_id
+        self.layers = torch.nn.Sequential(*build_layers(model_name, start, end, **model_kwargs))
+        self.finish_init()
+
+    def _initialize_weights(self):
+        if self.model_name in KAIMING_INIT:
+            initialize_weights(self)
+
+    def forward(self, x_rref, mb=None):
+        tik = time.time()
+
+        x = self.receive(x_rref, mb)
+        with self.micro_batch(x) as mb_scope:
+            out = self.layers(x)
+            out = mb_scope.keep(out)
+
+        tok = time.time()
+
+        print(f"chunk{self.chunk_id} mb{mb} time: {tok - tik}")
+        return out
+
+    def layer_range(self):
+        return self.start, self.end
+
+    def stash_optimizer_state(self, optim_rref):
+        r"""
+        Keep the optimizer state of this stage's parameters aside while the
+        master rebuilds its optimizer around a migration.
+        """
+        state = optim_rref.local_value().optim.state
+        self._optim_stash = {p: state[p] for p in self.parameters() if p in state}
+
+    def load_optimizer_state(self, optim_rref):
+        optim = optim_rref.local_value().optim
+        for p, s in getattr(self, "_optim_stash", {}).items():
+            optim.state[p] = s
+        self._optim_stash = {}
+
+    def migrate_to(self, neighbour_rref, side, k):
+        r"""
+        Hand ``k`` layers from the ``side`` ("front" or "back") of this stage
+        to the neighbouring stage, together with their stashed optimizer
+        state. Only called between batches.
+        """
+        with self._lock:
+            if k >= len(self.layers):
+                raise ValueError(f"chunk{self.chunk_id} cannot give away {k} of its {len(self.layers)} layers")
+            layers = list(self.layers)
+            moved, kept = (layers[:k], layers[k:]) if side == "front" else (layers[-k:], layers[:-k])
+            stash = getattr(self, "_optim_stash", {})
+            states = [stash.pop(p, None) for m in moved for p in m.parameters()]
+            for m in moved:
+                self.pool.uninstall(m)
+            self.layers = torch.nn.Sequential(*kept)
+            if side == "front":
+                self.start += k
+            else:
+                self.end -= k
+        neighbour_rref.rpc_sync().accept_layers("back" if side == "front" else "front", moved, states)
+        return self.layer_range()
+
+    def accept_layers(self, side, moved, states):
+        with self._lock:
+            layers = list(self.layers)
+            layers = layers + moved if side == "back" else moved + layers
+            self.layers = torch.nn.Sequential(*layers)
+            for m in moved:
+                self.pool.install(m)
+            if side == "back":
+                self.end += len(moved)
+            else:
+                self.start -= len(moved)
+            params = [p for m in moved for p in m.parameters()]
+            stash = getattr(self, "_optim_stash", {})
+            stash.update({p: s for p, s in zip(params, states) if s is not None})
+            self._optim_stash = stash
+        return self.layer_range()
+
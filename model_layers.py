@@ -0,0 +1,159 @@
+r"""
+The three template models as flat, ordered lists of layers. A pipeline can cut
+these lists anywhere, so the number of stages and where they start is no
+longer baked into hand-written Stage classes. ResNet's residual blocks are
+kept whole so no skip connection crosses a cut.
+
+Each list holds zero-argument factories rather than modules, so a stage only
+constructs (and allocates) the layers it owns.
+"""
+import torch
+
+
+class Bottleneck(torch.nn.Module):
+    def __init__(self, in_channels, width, stride=1):
+        super(Bottleneck, self).__init__()
+        out_channels = width * 4
+        self.conv1 = torch.nn.Conv2d(in_channels, width, kernel_size=(1, 1), stride=(1, 1), bias=False)
+        self.bn1 = torch.nn.BatchNorm2d(width, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
+        self.conv2 = torch.nn.Conv2d(width, width, kernel_size=(3, 3), stride=(stride, stride), padding=(1, 1), bias=False)
+        self.bn2 = torch.nn.BatchNorm2d(width, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
+        self.conv3 = torch.nn.Conv2d(width, out_channels, kernel_size=(1, 1), stride=(1, 1), bias=False)
+        self.bn3 = torch.nn.BatchNorm2d(out_channels, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
+        self.relu = torch.nn.ReLU(inplace=True)
+        self.downsample = None
+        if stride != 1 or in_channels != out_channels:
+            self.downsample = torch.nn.Sequential(
+                torch.nn.Conv2d(in_channels, out_channels, kernel_size=(1, 1), stride=(stride, stride), bias=False),
+                torch.nn.BatchNorm2d(out_channels, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+            )
+
+    def forward(self, x):
+        identity = x if self.downsample is None else self.downsample(x)
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.relu(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+        return self.relu(out + identity)
+
+
+def alexnet_layers(image_w=128, image_h=128, num_classes=1000):
+    def pooled(s):
+        return (s - 3) // 2 + 1
+
+    w = pooled(pooled(pooled((image_w + 4 - 11) // 4 + 1)))
+    h = pooled(pooled(pooled((image_h + 4 - 11) // 4 + 1)))
+    return [
+        lambda: torch.nn.Conv2d(3, 64, kernel_size=(11, 11), stride=(4, 4), padding=(2, 2)),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.MaxPool2d(kernel_size=3, stride=2, padding=0, dilation=1, ceil_mode=False),
+        lambda: torch.nn.Conv2d(64, 192, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2)),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.MaxPool2d(kernel_size=3, stride=2, padding=0, dilation=1, ceil_mode=False),
+        lambda: torch.nn.Conv2d(192, 384, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1)),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.Conv2d(384, 256, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1)),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.Conv2d(256, 256, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1)),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.MaxPool2d(kernel_size=3, stride=2, padding=0, dilation=1, ceil_mode=False),
+        lambda: torch.nn.Flatten(),
+        lambda: torch.nn.Dropout(p=0.5),
+        lambda: torch.nn.Linear(in_features=256 * w * h, out_features=4096, bias=True),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.Dropout(p=0.5),
+        lambda: torch.nn.Linear(in_features=4096, out_features=4096, bias=True),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.Linear(in_features=4096, out_features=num_classes, bias=True),
+    ]
+
+
+def vgg_layers(image_w=128, image_h=128, num_classes=1000):
+    cfg = [64, 64, "M", 128, 128, "M", 256, 256, 256, "M", 512, 512, 512, "M", 512, 512, 512, "M"]
+    layers = []
+    in_channels = 3
+    for v in cfg:
+        if v == "M":
+            layers.append(lambda: torch.nn.MaxPool2d(kernel_size=2, stride=2, padding=0, dilation=1, ceil_mode=False))
+        else:
+            layers.append(lambda i=in_channels, o=v: torch.nn.Conv2d(i, o, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1)))
+            layers.append(lambda: torch.nn.ReLU(inplace=True))
+            in_channels = v
+    features = 512 * (image_w // 32) * (image_h // 32)
+    layers.extend([
+        lambda: torch.nn.Flatten(),
+        lambda: torch.nn.Linear(in_features=features, out_features=4096, bias=True),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.Dropout(p=0.5),
+        lambda: torch.nn.Linear(in_features=4096, out_features=4096, bias=True),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.Dropout(p=0.5),
+        lambda: torch.nn.Linear(in_features=4096, out_features=num_classes, bias=True),
+    ])
+    return layers
+
+
+def resnet_layers(image_w=256, image_h=256, num_classes=1000):
+    layers = [
+        lambda: torch.nn.Conv2d(3, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False),
+        lambda: torch.nn.BatchNorm2d(64, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True),
+        lambda: torch.nn.ReLU(inplace=True),
+        lambda: torch.nn.MaxPool2d(kernel_size=3, stride=2, padding=1, dilation=1, ceil_mode=False),
+    ]
+    in_channels = 64
+    for width, blocks, stride in [(64, 3, 1), (128, 4, 2), (256, 6, 2), (512, 3, 2)]:
+        for b in range(blocks):
+            s = stride if b == 0 else 1
+            layers.append(lambda i=in_channels, w=width, s=s: Bottleneck(i, w, s))
+            in_channels = width * 4
+    w = max(image_w // 32 - 6, 1)
+    h = max(image_h // 32 - 6, 1)
+    layers.extend([
+        lambda: torch.nn.AvgPool2d(kernel_size=7, stride=1, padding=0),
+        lambda: torch.nn.Flatten(),
+        lambda: torch.nn.Linear(in_features=2048 * w * h, out_features=num_classes, bias=True),
+    ])
+    return layers
+
+
+MODELS = {
+    "alexnet": alexnet_layers,
+    "vgg": vgg_layers,
+    "resnet": resnet_layers,
+}
+
+# models whose templates re-initialise with kaiming/normal instead of the
+# PyTorch layer defaults
+KAIMING_INIT = {"vgg", "resnet"}
+
+
+def build_layers(name, start, end, **kwargs):
+    return [factory() for factory in MODELS[name](**kwargs)[start:end]]
+
+
+def num_layers(name, **kwargs):
+    return len(MODELS[name](**kwargs))
+
+
+def even_cuts(num_layers, num_stages):
+    r"""
+    Split ``num_layers`` layers into ``num_stages`` contiguous ranges of
+    (almost) equal length, returned as (start, end) pairs.
+    """
+    if num_stages > num_layers:
+        raise ValueError(f"cannot cut {num_layers} layers into {num_stages} stages")
+    bounds = [round(i * num_layers / num_stages) for i in range(num_stages + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def initialize_weights(module):
+    for m in module.modules():
+        if isinstance(m, torch.nn.Conv2d):
+            torch.nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            if m.bias is not None:
+                torch.nn.init.constant_(m.bias, 0)
+        elif isinstance(m, torch.nn.BatchNorm2d):
+            torch.nn.init.constant_(m.weight, 1)
+            torch.nn.init.constant_(m.bias, 0)
+        elif isinstance(m, torch.nn.Linear):
+            torch.nn.init.normal_(m.weight, 0, 0.01)
+            torch.nn.init.constant_(m.bias, 0)
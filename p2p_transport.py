@@ -0,0 +1,85 @@
+r"""
+Activations and gradients over torch.distributed point-to-point instead of
+RPC. Every RPC process also joins a gloo process group (ranks are the RPC
+ranks), and tensors move with ``isend``/``irecv``: no RRef, no RPC request
+framing and no distributed autograd send/recv functions per message. RPC is
+left for control: building the stages, starting a step, collecting losses.
+
+A receive has to be posted with the right shape before the data arrives, so
+the first step of a given batch layout goes over RPC and every executor
+records the shapes it was sent. From then on each executor pre-posts all of
+its receives for the step into pooled buffers as soon as the step starts.
+Each message has a fixed tag derived from (kind, chunk, micro-batch), so
+sends and receives pair up regardless of the order they are issued in.
+"""
+import torch.distributed as dist
+
+from buffer_pool import BufferPool
+
+
+# message kinds: stage input, label, gradient of a stage output
+KINDS = ("x", "y", "g")
+
+
+def init_p2p(rank, world_size, port=29502):
+    r"""
+    Join the gloo group used for point-to-point transfers. Every process,
+    master included, has to call this after ``init_rpc``. A group already
+    set up by ``hybrid.init_replica_groups`` is reused.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(
+            "gloo",
+            init_method=f"tcp://localhost:{port}",
+            rank=rank,
+            world_size=world_size
+        )
+
+
+def tag(kind, chunk, mb, num_chunks):
+    return (mb * num_chunks + chunk) * len(KINDS) + KINDS.index(kind)
+
+
+class P2PTransport(object):
+    r"""
+    One worker's pre-posted receives and outstanding sends. Receive buffers
+    come from a BufferPool and go back to it with ``release`` once the
+    micro-batch's backward is done; sent tensors are kept alive until
+    ``flush``.
+    """
+    def __init__(self, num_chunks, pool=None):
+        self.num_chunks = num_chunks
+        self.pool = pool if pool is not None else BufferPool()
+        self._recvs = {}
+        self._taken = {}
+        self._sends = []
+
+    def post(self, kind, chunk, mb, src, shape, dtype):
+        buf = self.pool.acquire(shape, dtype)
+        work = dist.irecv(buf, src, tag=tag(kind, chunk, mb, self.num_chunks))
+        self._recvs[(kind, chunk, mb)] = (work, buf)
+
+    def posted(self, key):
+        return key in self._recvs
+
+    def take(self, key):
+        work, buf = self._recvs.pop(key)
+        work.wait()
+        self._taken[key] = buf
+        return buf
+
+    def release(self, chunk, mb):
+        for kind in KINDS:
+            buf = self._taken.pop((kind, chunk, mb), None)
+            if buf is not None:
+                self.pool.release(buf)
+
+    def send(self, kind, chunk, mb, t, dst):
+        t = t.contiguous()
+        work = dist.isend(t, dst, tag=tag(kind, chunk, mb, self.num_chunks))
+        self._sends.append((work, t))
+
+    def flush(self):
+        for work, _ in self._sends:
+            work.wait()
+        self._sends = []
@@ -0,0 +1,189 @@
+r"""
+Choose where to cut a model into pipeline stages from a layer_profiler cost
+table, minimising the slowest stage while keeping every worker under its
+memory cap.
+
+A stage's memory is
+
+    parameters x (1 weight + 1 gradient + optimizer_state_factor)
+    + in-flight micro-batches x activations saved for backward
+    + its output activation
+
+where the number of micro-batches in flight on each stage is read off the
+schedule (every F not yet matched by its B), so GPipe keeps all ``m`` while
+1F1B keeps ``p - s`` on stage ``s``. Activation sizes are scaled from the
+profiled micro-batch size to ``split_size``.
+"""
+import json
+import sys
+
+from schedule_ops import make_schedule
+
+
+# optimizer state per parameter byte
+OPTIMIZER_STATE = {
+    "sgd": 0,
+    "sgd_momentum": 1,
+    "adam": 2,
+}
+
+
+def in_flight(schedule, num_stages, num_micro_batches, chunks_per_worker=1):
+    r"""
+    Peak number of micro-batches each stage holds activations for, walking
+    each worker's op list in order. With several chunks per worker every
+    chunk is a stage, ``num_stages`` of them in all.
+    """
+    held = [0] * num_stages
+    peaks = [0] * num_stages
+    for ops in make_schedule(schedule, num_stages // chunks_per_worker, num_micro_batches, chunks_per_worker):
+        for kind, c, _ in ops:
+            if kind == "F":
+                held[c] += 1
+                peaks[c] = max(peaks[c], held[c])
+            elif kind == "B":
+                held[c] -= 1
+    return peaks
+
+
+def stage_memory(rows, start, end, in_flight_mbs, scale, optimizer_state_factor):
+    part = rows[start:end]
+    params = sum(r["param_bytes"] for r in part)
+    saved = sum(r["saved_bytes"] for r in part) * scale
+    return {
+        "params": params,
+        "grads": params,
+        "optimizer": params * optimizer_state_factor,
+        "activations": in_flight_mbs * saved,
+        "output": part[-1]["activation_bytes"] * scale,
+        "total": params * (2 + optimizer_state_factor) + in_flight_mbs * saved + part[-1]["activation_bytes"] * scale,
+    }
+
+
+def stage_time(rows, start, end, scale, cost_model=None):
+    part = rows[start:end]
+    ms = sum(r["forward_ms"] + r["backward_ms"] for r in part) * scale
+    if cost_model is not None and end < len(rows):
+        from comm_benchmark import transfer_ms
+        # activation forward, gradient back
+        ms += 2 * transfer_ms(cost_model, part[-1]["activation_bytes"] * scale)[0]
+    return ms
+
+
+def _caps(memory_caps, num_stages):
+    if memory_caps is None:
+        return [float("inf")] * num_stages
+    if isinstance(memory_caps, (int, float)):
+        return [memory_caps] * num_stages
+    if len(memory_caps) != num_stages:
+        raise ValueError(f"got {len(memory_caps)} memory caps for {num_stages} stages")
+    return list(memory_caps)
+
+
+def partition(rows, num_stages, split_size, batch_size, memory_caps=None, schedule="gpipe",
+              optimizer_state_factor=0, cost_model=None, chunks_per_worker=1):
+    r"""
+    Contiguous cuts of the layers in ``rows`` into ``num_stages`` stages
+    minimising the slowest stage's time per micro-batch, subject to stage
+    ``s`` fitting in ``memory_caps[s]`` bytes (one cap for all, or none).
+    With ``chunks_per_worker`` above 1 the stages are the chunks, so the
+    caps are per chunk. Raises ValueError when no partition fits.
+    """
+    n = len(rows)
+    caps = _caps(memory_caps, num_stages)
+    scale = split_size / rows[0]["micro_batch_size"]
+    num_micro_batches = -(-batch_size // split_size)
+    flights = in_flight(schedule, num_stages, num_micro_batches, chunks_per_worker)
+
+    inf = float("inf")
+    # best[s][j]: slowest stage time placing layers [0, j) on stages 0..s
+    best = [[inf] * (n + 1) for _ in range(num_stages)]
+    choice = [[None] * (n + 1) for _ in range(num_stages)]
+    for s in range(num_stages):
+        for j in range(s + 1, n - (num_stages - s - 1) + 1):
+            starts = [0] if s == 0 else range(s, j)
+            for i in starts:
+                prev = 0.0 if s == 0 else best[s - 1][i]
+                if prev == inf:
+                    continue
+                mem = stage_memory(rows, i, j, flights[s], scale, optimizer_state_factor)["total"]
+                if mem > caps[s]:
+                    continue
+                t = max(prev, stage_time(rows, i, j, scale, cost_model))
+                if t < best[s][j]:
+                    best[s][j] = t
+                    choice[s][j] = i
+
+    if best[num_stages - 1][n] == inf:
+        raise ValueError(
+            f"no partition of {n} layers into {num_stages} stages fits the memory caps "
+            f"(smallest stage needs {min_stage_bytes(rows, scale, flights, optimizer_state_factor) / 2**20:.3f} MB, "
+            f"smallest cap is {min(caps) / 2**20:.3f} MB)"
+        )
+
+    cuts = []
+    j = n
+    for s in reversed(range(num_stages)):
+        i = choice[s][j]
+        cuts.append((i, j))
+        j = i
+    cuts.reverse()
+    return cuts
+
+
+def min_stage_bytes(rows, scale, flights, optimizer_state_factor):
+    # the heaviest single layer on the stage holding the most micro-batches
+    return max(
+        stage_memory(rows, i, i + 1, max(flights), scale, optimizer_state_factor)["total"]
+        for i in range(len(rows))
+    )
+
+
+def check_cuts(rows, cuts, split_size, batch_size, memory_caps=None, schedule="gpipe",
+               optimizer_state_factor=0, cost_model=None, chunks_per_worker=1):
+    r"""
+    Per-stage time and memory of a given partition, with a ``fits`` flag per
+    stage, so hand-picked cuts can be vetted before a run.
+    """
+    caps = _caps(memory_caps, len(cuts))
+    scale = split_size / rows[0]["micro_batch_size"]
+    flights = in_flight(schedule, len(cuts), -(-batch_size // split_size), chunks_per_worker)
+    report = []
+    for s, (start, end) in enumerate(cuts):
+        mem = stage_memory(rows, start, end, flights[s], scale, optimizer_state_factor)
+        report.append({
+            "stage": s,
+            "start": start,
+            "end": end,
+            "ms": stage_time(rows, start, end, scale, cost_model),
+            "in_flight": flights[s],
+            "memory": mem,
+            "cap": caps[s],
+            "fits": mem["total"] <= caps[s],
+        })
+    return report
+
+
+def print_partition(report):
+    mb = 2 ** 20
+    print(f"{'stage':<7}{'layers':>9}{'ms/mb':>9}{'in flight':>11}{'params MB':>11}{'optim MB':>10}"
+          f"{'acts MB':>9}{'total MB':>10}{'cap MB':>9}")
+    for r in report:
+        m = r["memory"]
+        cap = "-" if r["cap"] == float("inf") else f"{r['cap'] / mb:.1f}"
+        print(f"{r['stage']:<7}{r['start']:>4}-{r['end']:<4}{r['ms']:>9.2f}{r['in_flight']:>11}"
+              f"{(m['params'] + m['grads']) / mb:>11.1f}{m['optimizer'] / mb:>10.1f}{m['activations'] / mb:>9.1f}"
+              f"{m['total'] / mb:>10.1f}{cap:>9}{'' if r['fits'] else '  over cap'}")
+
+
+if __name__=="__main__":
+    # python partitioner.py <cost table> <stages> <split size> <cap MB per worker> [schedule] [optimizer]
+    with open(sys.argv[1]) as f:
+        rows = json.load(f)
+    num_stages, split_size = int(sys.argv[2]), int(sys.argv[3])
+    cap = float(sys.argv[4]) * 2 ** 20
+    schedule = sys.argv[5] if len(sys.argv) > 5 else "gpipe"
+    factor = OPTIMIZER_STATE[sys.argv[6] if len(sys.argv) > 6 else "sgd"]
+    cuts = partition(rows, num_stages, split_size, 128, cap, schedule, factor)
+    print(f"cuts: {cuts}")
+    print_partition(check_cuts(rows, cuts, split_size, 128, cap, schedule, factor))
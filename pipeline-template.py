@@ -0,0 +1,176 @@
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed.autograd as dist_autograd
+import torch.distributed.rpc as rpc
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.distributed.optim import DistributedOptimizer
+
+from bubble_analyzer import analyze
+from partitioner import check_cuts, partition, print_partition
+from p2p_transport import init_p2p
+from pipeline import DistLayerPipeline
+from placement import plan_placement, print_plan, rank_cpus, validate_plan
+from rebalance import Rebalancer
+from schedule import ScheduledPipeline
+
+num_classes = 1000
+
+
+#########################################################
+#                   Run RPC Processes                   #
+#########################################################
+
+model_name = "alexnet"
+num_batches = 1
+batch_size = 128
+image_w = 128
+image_h = 128
+
+# None runs all forwards and one distributed autograd pass; "gpipe", "1f1b"
+# or "interleaved" run that schedule with explicit forward/backward messages
+schedule = None
+chunks_per_worker = 1
+# how a schedule moves activations and gradients: "rpc", or "p2p" for
+# torch.distributed isend/irecv with RPC kept for control
+transport = "rpc"
+
+# cut by a layer_profiler cost table for model_name instead of by layer
+# count, keeping each worker under memory_cap_mb (None for no cap; split
+# evenly between a worker's chunks)
+cost_table = None
+memory_cap_mb = None
+
+# move boundary layers off a stage that runs rebalance_threshold slower than
+# its neighbour over rebalance_window batches (None keeps the cuts fixed)
+rebalance_threshold = None
+rebalance_window = 2
+
+
+def run_master(split_size, workers):
+
+    cuts = None
+    rows = None
+    if cost_table is not None:
+        with open(cost_table) as f:
+            rows = json.load(f)
+        cap = memory_cap_mb * 2 ** 20 / chunks_per_worker if memory_cap_mb is not None else None
+        # one cut per chunk, not per worker
+        num_chunks = len(workers) * chunks_per_worker
+        cuts = partition(rows, num_chunks, split_size, batch_size, cap, schedule or "gpipe",
+                         chunks_per_worker=chunks_per_worker)
+        print_partition(check_cuts(rows, cuts, split_size, batch_size, cap, schedule or "gpipe",
+                                   chunks_per_worker=chunks_per_worker))
+
+    # chunks_per_worker stages per worker, cut evenly by layer count unless
+    # the partitioner chose the cuts
+    model = DistLayerPipeline(model_name, split_size, workers, len(workers) * chunks_per_worker, cuts,
+                              image_w=image_w, image_h=image_h, num_classes=num_classes)
+    loss_fn = nn.MSELoss()
+    if schedule is not None:
+        trainer = ScheduledPipeline(model, schedule, optim.SGD, loss_fn, transport, lr=0.05)
+    else:
+        opt = DistributedOptimizer(
+            optim.SGD,
+            model.parameter_rrefs(),
+            lr=0.05,
+        )
+    rebalancer = None
+    if rebalance_threshold is not None and schedule is None:
+        rebalancer = Rebalancer(model, optim.SGD, rebalance_window, rebalance_threshold, rows, lr=0.05)
+    model.wait_ready()
+
+    one_hot_indices = torch.LongTensor(batch_size) \
+                           .random_(0, num_classes) \
+                           .view(batch_size, 1)
+
+    if schedule is not None and transport == "p2p":
+        # the first step of a batch layout goes over RPC to record receive
+        # shapes; run it untimed so the timed steps use isend/irecv
+        trainer.train_step(torch.randn(batch_size, 3, image_w, image_h),
+                           torch.zeros(batch_size, num_classes).scatter_(1, one_hot_indices, 1))
+
+    for i in range(num_batches):
+        print(f"Processing batch {i}")
+        # generate random inputs and labels
+        inputs = torch.randn(batch_size, 3, image_w, image_h)
+        labels = torch.zeros(batch_size, num_classes) \
+                      .scatter_(1, one_hot_indices, 1)
+
+        if schedule is not None:
+            print(f"{schedule} loss: {trainer.train_step(inputs, labels)}")
+            continue
+
+        with dist_autograd.context() as context_id:
+            outputs = model(inputs)
+            dist_autograd.backward(context_id, [loss_fn(outputs, labels)])
+            opt.step(context_id)
+
+        if rebalancer is not None:
+            rebalancer.observe(analyze(model.timings()))
+            if rebalancer.due():
+                opt = rebalancer.rebalance(opt)
+
+
+def run_worker(rank, world_size, split_size, plan):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=256, rpc_timeout=600)
+
+    import psutil
+    p = psutil.Process()
+
+    if rank == 0:
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
+
+        rpc.init_rpc(
+            "master",
+            rank=rank,
+            world_size=world_size,
+            rpc_backend_options=options
+        )
+        if schedule is not None and transport == "p2p":
+            init_p2p(rank, world_size)
+        run_master(split_size, [f"worker{r}" for r in range(1, world_size)])
+    else:
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
+
+        rpc.init_rpc(
+            f"worker{rank}",
+            rank=rank,
+            world_size=world_size,
+            rpc_backend_options=options
+        )
+        if schedule is not None and transport == "p2p":
+            init_p2p(rank, world_size)
+
+    # block until all rpcs finish
+    rpc.shutdown()
+
+
+if __name__=="__main__":
+    split_size = 8
+    for num_stages in [2, 4, 8, 16]:
+        # the master plus one worker per stage
+        world_size = num_stages + 1
+        plan = plan_placement(world_size - 1)
+        try:
+            print_plan(plan, warnings=validate_plan(plan))
+        except ValueError as e:
+            # too few CPUs for one per rank: run unpinned, with stages sharing cores
+            print(f"{num_stages} stages: placement: {e}, running without CPU affinity")
+            plan = None
+        tik = time.time()
+        mp.spawn(run_worker, args=(world_size, split_size, plan), nprocs=world_size, join=True)
+        tok = time.time()
+        print(f"{num_stages} stages: execution time = {tok - tik}")
@@ -0,0 +1,200 @@
+from collections import deque
+
+import torch
+import torch.nn as nn
+import torch.distributed.rpc as rpc
+from torch.distributed.rpc import RRef
+
+from layer_stage import LayerStage
+from model_layers import even_cuts, num_layers
+
+
+class DistPipeline(nn.Module):
+    r"""
+    A pipeline over any number of stages. ``stages`` is a list of
+    (stage class, args, kwargs); stage ``i`` is constructed on
+    ``workers[i % len(workers)]``, so more stages than workers wraps around.
+
+    ``max_in_flight`` caps the micro-batches that have been sent into the
+    pipeline but not come out of it (see CreditWindow); None sends them all
+    at once.
+
+    ``prefetch_depth`` and ``await_snapshot`` are passed on to every stage
+    (see StageBase).
+    """
+    def __init__(self, split_size, workers, stages, prefetch_depth=None, await_snapshot=False, max_in_flight=None):
+        super(DistPipeline, self).__init__()
+
+        self.split_size = split_size
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.prefetch_depth = prefetch_depth
+        options = {"prefetch_depth": prefetch_depth, "await_snapshot": await_snapshot}
+        self.p_rrefs = [
+            rpc.remote(
+                workers[i % len(workers)],
+                stage,
+                args=args,
+                kwargs=dict(kwargs, **options),
+                timeout=0
+            )
+            for i, (stage, args, kwargs) in enumerate(stages)
+        ]
+
+    def forward(self, xs):
+        # collect and cat all output tensors into one tensor.
+        return torch.cat(torch.futures.wait_all(self.dispatch(xs)))
+
+    def dispatch(self, xs):
+        # Split the input batch xs into micro-batches, and collect async RPC
+        # futures into a list
+        issuer = self.issue(xs)
+        while not issuer.done():
+            issuer.window.acquire()
+            issuer.send_next()
+        return issuer.futures
+
+    def issue(self, xs):
+        r"""
+        Start a step over the batch ``xs`` and return the Issuer that sends
+        its micro-batches.
+        """
+        self.begin_step()
+        return Issuer(self, xs)
+
+    def send(self, x, mb):
+        rref = RRef(x)
+        for p_rref in self.p_rrefs[:-1]:
+            rref = p_rref.remote().forward(rref, mb)
+        return self.p_rrefs[-1].rpc_async().forward(rref, mb)
+
+    def stage_rrefs(self):
+        return list(self.p_rrefs)
+
+    def begin_step(self):
+        # only prefetching stages keep state across a step
+        if self.prefetch_depth is not None:
+            torch.futures.wait_all([p.rpc_async().begin_step() for p in self.p_rrefs])
+
+    def wait_ready(self):
+        # the stages are constructed concurrently, so wait on all of them at once
+        torch.futures.wait_all([p.rpc_async().ready() for p in self.p_rrefs])
+
+    def parameter_rrefs(self):
+        remote_params = []
+        for params in torch.futures.wait_all([p.rpc_async().parameter_rrefs() for p in self.p_rrefs]):
+            remote_params.extend(params)
+        return remote_params
+
+    def timings(self):
+        return torch.futures.wait_all([p.rpc_async().timings() for p in self.p_rrefs])
+
+    def cpu_times(self):
+        return torch.futures.wait_all([p.rpc_async().cpu_time() for p in self.p_rrefs])
+
+    def buffer_stats(self):
+        return torch.futures.wait_all([p.rpc_async().buffer_stats() for p in self.p_rrefs])
+
+    def memory_begin(self):
+        torch.futures.wait_all([p.rpc_async().memory_begin() for p in self.p_rrefs])
+
+    def memory_reports(self):
+        return torch.futures.wait_all([p.rpc_async().memory_report() for p in self.p_rrefs])
+
+
+class Issuer(object):
+    r"""
+    One step's micro-batches for one pipeline, sent one at a time. With
+    ``max_in_flight`` set a micro-batch should only be sent once ``ready``;
+    ``window.acquire()`` blocks until it is.
+    """
+    def __init__(self, pipeline, xs):
+        self.pipeline = pipeline
+        self.xs = xs.split(pipeline.split_size, dim=0)
+        self.window = CreditWindow(pipeline.max_in_flight)
+        self.futures = []
+
+    def done(self):
+        return len(self.futures) == len(self.xs)
+
+    def ready(self):
+        return self.window.has_credit()
+
+    def send_next(self):
+        mb = len(self.futures)
+        fut = self.pipeline.send(self.xs[mb], mb)
+        self.window.add(fut)
+        self.futures.append(fut)
+        return fut
+
+
+class CreditWindow(object):
+    r"""
+    Credit-based flow control for the master. The pipeline holds
+    ``credits`` micro-batches; sending one takes a credit, and the credit
+    comes back when that micro-batch leaves the last stage. With no credit
+    free the master waits on the oldest micro-batch in flight, so a slow
+    stage holds back the stages upstream of it instead of piling up RPCs.
+    Every stage then has at most ``credits`` forward calls queued, each of
+    which would otherwise hold one of its RPC threads waiting on the stage
+    lock.
+    """
+    def __init__(self, credits):
+        if credits is not None and credits < 1:
+            raise ValueError(f"a pipeline needs at least 1 credit, got {credits}")
+        self.credits = credits
+        self.in_flight = deque()
+
+    def acquire(self):
+        if self.credits is None:
+            return
+        while len(self.in_flight) >= self.credits:
+            self.in_flight.popleft().wait()
+
+    def has_credit(self):
+        r"""
+        Whether a micro-batch can be sent without waiting. Micro-batches that
+        have left the pipeline give their credit back here.
+        """
+        if self.credits is None:
+            return True
+        self.in_flight = deque(f for f in self.in_flight if not f.done())
+        return len(self.in_flight) < self.credits
+
+    def add(self, fut):
+        if self.credits is not None:
+            self.in_flight.append(fut)
+
+
+def layer_stages(model_name, num_stages, cuts=None, **model_kwargs):
+    r"""
+    Stage specs cutting ``model_name`` into ``num_stages`` LayerStages, evenly
+    by layer count unless explicit (start, end) ``cuts`` are given.
+    """
+    if cuts is None:
+        cuts = even_cuts(num_layers(model_name, **model_kwargs), num_stages)
+    if len(cuts) != num_stages:
+        raise ValueError(f"got {len(cuts)} cuts for {num_stages} stages")
+    return [
+        (LayerStage, (model_name, start, end, i), model_kwargs)
+        for i, (start, end) in enumerate(cuts)
+    ]
+
+
+class DistLayerPipeline(DistPipeline):
+    r"""
+    ``model_name`` from model_layers cut into ``num_stages`` stages, one per
+    worker unless there are fewer workers than stages.
+    """
+    def __init__(self, model_name, split_size, workers, num_stages=None, cuts=None,
+                 prefetch_depth=None, await_snapshot=False, max_in_flight=None, **model_kwargs):
+        if num_stages is None:
+            num_stages = len(cuts) if cuts is not None else len(workers)
+        super(DistLayerPipeline, self).__init__(
+            split_size,
+            workers,
+            layer_stages(model_name, num_stages, cuts, **model_kwargs),
+            prefetch_depth,
+            await_snapshot,
+            max_in_flight
+        )
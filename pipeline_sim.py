@@ -0,0 +1,205 @@
+r"""
+Discrete-event simulation of one training step of a pipeline, so partitions,
+split sizes and schedules can be compared without spawning anything.
+
+Inputs are per-chunk forward/backward costs (ms per micro-batch), the saved
+activation bytes each chunk holds until its backward, the transfer cost of
+every cut, and a schedule from schedule_ops: for each worker, the order it
+runs its ("F" | "B", chunk, micro-batch) operations in (Step operations are
+not simulated). Chunk ``c`` lives on worker ``c % num_workers``.
+
+An operation starts once its worker is free and its inputs have arrived:
+
+    F(c, mb)   after F(c - 1, mb) plus the transfer across cut c - 1
+    B(c, mb)   after F(c, mb), and B(c + 1, mb) plus the transfer back
+"""
+import json
+import sys
+
+from schedule_ops import make_schedule
+
+
+def simulate(costs, schedule, step_ms=0.0):
+    r"""
+    Run ``schedule`` over chunk ``costs`` (a list of dicts with forward_ms,
+    backward_ms, saved_bytes and transfer_ms, the last being the cost of
+    sending the chunk's output on, and the gradient back). Returns the step
+    time, bubble fraction, per-worker busy time, peak in-flight activation
+    bytes per worker and the timeline of (worker, op, start, end).
+    """
+    num_workers = len(schedule)
+    num_chunks = len(costs)
+    finish = {}
+    free = [0.0] * num_workers
+    pos = [0] * num_workers
+    timeline = []
+    remaining = sum(len(ops) for ops in schedule)
+
+    while remaining:
+        progressed = False
+        for w, ops in enumerate(schedule):
+            while pos[w] < len(ops):
+                kind, c, mb = ops[pos[w]]
+                if kind == "S":
+                    # the optimizer step is added once at the end
+                    pos[w] += 1
+                    remaining -= 1
+                    progressed = True
+                    continue
+                if kind == "F":
+                    deps = [(("F", c - 1, mb), costs[c - 1]["transfer_ms"])] if c > 0 else []
+                    cost = costs[c]["forward_ms"]
+                else:
+                    deps = [(("F", c, mb), 0.0)]
+                    if c < num_chunks - 1:
+                        deps.append((("B", c + 1, mb), costs[c]["transfer_ms"]))
+                    cost = costs[c]["backward_ms"]
+                if any(d not in finish for d, _ in deps):
+                    break
+                start = max([free[w]] + [finish[d] + t for d, t in deps])
+                finish[(kind, c, mb)] = start + cost
+                free[w] = start + cost
+                timeline.append((w, (kind, c, mb), start, start + cost))
+                pos[w] += 1
+                remaining -= 1
+                progressed = True
+        if not progressed:
+            stuck = {w: schedule[w][pos[w]] for w in range(num_workers) if pos[w] < len(schedule[w])}
+            raise ValueError(f"schedule deadlocks; blocked operations: {stuck}")
+
+    end = max(free) + step_ms
+    busy = [0.0] * num_workers
+    for w, _, start, stop in timeline:
+        busy[w] += stop - start
+
+    # activations are held from the end of a chunk's forward to the end of
+    # its backward
+    peak = []
+    for w in range(num_workers):
+        events = []
+        for ww, (kind, c, mb), start, stop in timeline:
+            if ww == w:
+                events.append((stop, 1 if kind == "F" else -1, costs[c]["saved_bytes"]))
+        held = best = 0
+        for _, sign, nbytes in sorted(events, key=lambda e: (e[0], e[1])):
+            held += sign * nbytes
+            best = max(best, held)
+        peak.append(best)
+
+    return {
+        "step_ms": end,
+        "bubble": 1 - sum(busy) / (num_workers * end) if end else 0.0,
+        "busy_ms": busy,
+        "peak_inflight_bytes": peak,
+        "timeline": timeline,
+    }
+
+
+def chunk_costs(rows, cuts, split_size, cost_model=None):
+    r"""
+    Per-chunk costs from a layer_profiler cost table, scaled linearly from
+    the profiled micro-batch size to ``split_size``. Transfers come from a
+    comm_benchmark cost model if one is given, and are free otherwise.
+    """
+    from comm_benchmark import transfer_ms
+    from layer_profiler import stage_costs
+
+    scale = split_size / rows[0]["micro_batch_size"]
+    costs = []
+    for s in stage_costs(rows, cuts):
+        nbytes = s["boundary_bytes"] * scale
+        costs.append({
+            "forward_ms": s["forward_ms"] * scale,
+            "backward_ms": s["backward_ms"] * scale,
+            "saved_bytes": s["saved_bytes"] * scale,
+            "transfer_ms": transfer_ms(cost_model, nbytes)[0] if cost_model else 0.0,
+        })
+    return costs
+
+
+def costs_from_timings(stage_timings, backward_ratio=2.0, transfer_ms=0.0):
+    r"""
+    Chunk costs from a real run's StageBase timings: the median forward
+    compute per micro-batch, and the union of the backward intervals over
+    the micro-batch count, since distributed autograd runs the backwards
+    interleaved. A chunk whose backward was not timed (a forward-only run)
+    gets ``backward_ratio`` times its forward.
+    """
+    from bubble_analyzer import backward_intervals, union_length
+
+    costs = []
+    for timings in stage_timings:
+        compute = sorted(1000 * (r["end"] - r["start"]) for r in timings)
+        forward = compute[len(compute) // 2] if compute else 0.0
+        grads = backward_intervals(timings)
+        costs.append({
+            "forward_ms": forward,
+            "backward_ms": 1000 * union_length(grads) / len(grads) if grads else backward_ratio * forward,
+            "saved_bytes": 0,
+            "transfer_ms": transfer_ms,
+        })
+    return costs
+
+
+def predict(rows, num_stages, split_size, batch_size, schedule="gpipe", chunks_per_worker=1,
+            cuts=None, cost_model=None):
+    from model_layers import even_cuts
+
+    num_chunks = num_stages * chunks_per_worker
+    if cuts is None:
+        cuts = even_cuts(len(rows), num_chunks)
+    num_micro_batches = -(-batch_size // split_size)
+    costs = chunk_costs(rows, cuts, split_size, cost_model)
+    return simulate(costs, make_schedule(schedule, num_stages, num_micro_batches, chunks_per_worker))
+
+
+def validation_error(predicted_ms, measured_s):
+    r"""
+    Relative error of a prediction against a measured step time (seconds,
+    as the templates print them).
+    """
+    return (predicted_ms / 1000 - measured_s) / measured_s
+
+
+def print_validation(stage_timings, measured_s, schedule="gpipe", chunks_per_worker=1, backward_ratio=2.0):
+    r"""
+    Replay a real step from its own timings under the schedule it ran
+    (``stage_timings`` has one list per chunk) and compare the simulated
+    step with the measured one. A step driven by one distributed autograd
+    backward runs as "gpipe".
+    """
+    costs = costs_from_timings(stage_timings, backward_ratio)
+    num_micro_batches = max(len(t) for t in stage_timings)
+    r = simulate(costs, make_schedule(schedule, len(costs) // chunks_per_worker, num_micro_batches, chunks_per_worker))
+    print(f"simulated {schedule} step: {r['step_ms'] / 1000:.3f}s (bubble {r['bubble']:.2f}), measured {measured_s:.3f}s, "
+          f"error {100 * validation_error(r['step_ms'], measured_s):+.1f}%")
+
+
+def print_sweep(rows, stage_counts, split_sizes, batch_size, cost_model=None):
+    mb = 1024 * 1024
+    print(f"{'stages':>7}{'split':>7}{'schedule':>13}{'step ms':>10}{'bubble':>8}{'peak MB':>9}")
+    for num_stages in stage_counts:
+        for split_size in split_sizes:
+            m = -(-batch_size // split_size)
+            plans = [("gpipe", 1), ("1f1b", 1)]
+            if m % num_stages == 0 and 2 * num_stages <= len(rows):
+                plans.append(("interleaved", 2))
+            for schedule, v in plans:
+                r = predict(rows, num_stages, split_size, batch_size, schedule, v, cost_model=cost_model)
+                print(f"{num_stages:>7}{split_size:>7}{schedule + ('' if v == 1 else f'x{v}'):>13}"
+                      f"{r['step_ms']:>10.1f}{r['bubble']:>8.2f}{max(r['peak_inflight_bytes']) / mb:>9.1f}")
+
+
+if __name__=="__main__":
+    # python pipeline_sim.py <cost table> [comm model] [measured step seconds]
+    with open(sys.argv[1]) as f:
+        rows = json.load(f)
+    cost_model = None
+    if len(sys.argv) > 2:
+        from comm_benchmark import load_cost_model
+        cost_model = load_cost_model(sys.argv[2])
+    print_sweep(rows, [2, 4, 8], [1, 4, 8, 16], batch_size=128, cost_model=cost_model)
+    if len(sys.argv) > 3:
+        r = predict(rows, 4, 8, 128, cost_model=cost_model)
+        print(f"4 stages, split 8, gpipe: predicted {r['step_ms'] / 1000:.3f}s, "
+              f"error {100 * validation_error(r['step_ms'], float(sys.argv[3])):+.1f}%")
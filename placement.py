@@ -0,0 +1,179 @@
+r"""
+Core placement for the master and the pipeline workers, planned from the
+machine topology in sysfs before any process is spawned.
+
+The planner takes one hardware thread per physical core (SMT siblings only
+when the physical cores run out), walks the cores domain by domain
+(NUMA node, then L3), gives the master its own cores first and then hands
+out consecutive cores to workers 1, 2, ... so neighbouring stages share a
+cache and memory controller. A worker is never split across two domains if
+the next domain can hold it whole.
+"""
+import glob
+import os
+
+
+def _parse_list(text):
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def read_topology(sysfs="/sys/devices/system"):
+    r"""
+    One dict per usable CPU: its physical core, SMT siblings, L3 domain
+    (lowest CPU sharing the L3) and NUMA node. Missing sysfs entries fall
+    back to one core per CPU in a single domain.
+    """
+    numa = {}
+    for node in glob.glob(os.path.join(sysfs, "node", "node[0-9]*")):
+        for cpu in _parse_list(_read(os.path.join(node, "cpulist"), "")):
+            numa[cpu] = int(os.path.basename(node)[len("node"):])
+
+    topology = []
+    for cpu in sorted(os.sched_getaffinity(0)):
+        base = os.path.join(sysfs, "cpu", f"cpu{cpu}")
+        siblings = _parse_list(_read(os.path.join(base, "topology", "thread_siblings_list"), str(cpu)))
+        package = int(_read(os.path.join(base, "topology", "physical_package_id"), "0"))
+        l3 = None
+        for index in glob.glob(os.path.join(base, "cache", "index[0-9]*")):
+            if _read(os.path.join(index, "level")) == "3":
+                l3 = min(_parse_list(_read(os.path.join(index, "shared_cpu_list"), str(cpu))))
+        topology.append({
+            "cpu": cpu,
+            "core": min(siblings),
+            "siblings": siblings,
+            "package": package,
+            "l3": l3 if l3 is not None else package,
+            "numa": numa.get(cpu, 0),
+        })
+    return topology
+
+
+def _domain(entry):
+    return (entry["numa"], entry["l3"])
+
+
+def plan_placement(num_workers, cores_per_worker=1, master_cores=1, topology=None):
+    r"""
+    Assign ``master_cores`` CPUs to the master and ``cores_per_worker`` CPUs
+    to each of ``num_workers`` workers. Returns {"master": [...],
+    "workers": [[...], ...]}. If the machine is too small the assignment
+    wraps around and some CPUs are shared, which ``validate_plan`` rejects.
+    """
+    if topology is None:
+        topology = read_topology()
+    by_cpu = {e["cpu"]: e for e in topology}
+
+    # physical cores first, SMT siblings after them, each in domain order
+    primary = [e for e in topology if e["cpu"] == e["core"]]
+    secondary = [e for e in topology if e["cpu"] != e["core"]]
+    order = sorted(primary, key=lambda e: (_domain(e), e["cpu"])) + \
+            sorted(secondary, key=lambda e: (_domain(e), e["cpu"]))
+    cpus = [e["cpu"] for e in order]
+
+    taken = []
+
+    def take(n):
+        if len(taken) + n > len(cpus):
+            # out of CPUs: wrap around and share
+            start = len(taken) % len(cpus)
+            chosen = [cpus[(start + i) % len(cpus)] for i in range(n)]
+            taken.extend(chosen)
+            return chosen
+        # do not straddle a domain boundary if the next domain fits n
+        start = len(taken)
+        first = _domain(by_cpu[cpus[start]])
+        last = _domain(by_cpu[cpus[start + n - 1]])
+        if first != last:
+            boundary = next(i for i in range(start, start + n) if _domain(by_cpu[cpus[i]]) != first)
+            if boundary + n <= len(cpus) and \
+                    _domain(by_cpu[cpus[boundary]]) == _domain(by_cpu[cpus[boundary + n - 1]]):
+                taken.extend(cpus[start:boundary])
+                start = boundary
+        chosen = cpus[start:start + n]
+        taken.extend(chosen)
+        return chosen
+
+    return {
+        "master": take(master_cores),
+        "workers": [take(cores_per_worker) for _ in range(num_workers)],
+    }
+
+
+def validate_plan(plan, topology=None):
+    r"""
+    Check a plan before it is used. CPUs outside this process's affinity and
+    CPUs given to two ranks raise a ValueError. Softer problems, physical
+    cores shared through SMT siblings and adjacent workers in different
+    L3/NUMA domains, are returned as a list of warnings.
+    """
+    if topology is None:
+        topology = read_topology()
+    by_cpu = {e["cpu"]: e for e in topology}
+    ranks = _ranks(plan)
+
+    errors = []
+    warnings = []
+    cpu_owner = {}
+    core_owner = {}
+    for name, cpus in ranks:
+        if not cpus:
+            errors.append(f"{name} has no CPUs")
+        for cpu in cpus:
+            if cpu not in by_cpu:
+                errors.append(f"{name}: CPU {cpu} is not available to this process")
+                continue
+            if cpu in cpu_owner:
+                errors.append(f"{name} shares CPU {cpu} with {cpu_owner[cpu]}")
+                continue
+            cpu_owner[cpu] = name
+            core = by_cpu[cpu]["core"]
+            if core_owner.setdefault(core, name) != name:
+                warnings.append(f"{name} shares physical core {core} with {core_owner[core]} (SMT)")
+
+    for (a, ca), (b, cb) in zip(ranks[1:], ranks[2:]):
+        da = {_domain(by_cpu[c]) for c in ca if c in by_cpu}
+        db = {_domain(by_cpu[c]) for c in cb if c in by_cpu}
+        if da and db and not da & db:
+            warnings.append(f"{a} and {b} are in different L3/NUMA domains")
+
+    if errors:
+        raise ValueError("invalid core placement:\n  " + "\n  ".join(errors))
+    return warnings
+
+
+def _ranks(plan):
+    return [("master", plan["master"])] + [(f"worker{i + 1}", c) for i, c in enumerate(plan["workers"])]
+
+
+def print_plan(plan, topology=None, warnings=None):
+    if topology is None:
+        topology = read_topology()
+    by_cpu = {e["cpu"]: e for e in topology}
+    print(f"{'rank':<10}{'cpus':<16}{'numa':>6}{'l3':>6}")
+    for name, cpus in _ranks(plan):
+        domains = sorted({_domain(by_cpu[c]) for c in cpus if c in by_cpu})
+        print(f"{name:<10}{','.join(str(c) for c in cpus):<16}"
+              f"{'/'.join(str(d[0]) for d in domains):>6}{'/'.join(str(d[1]) for d in domains):>6}")
+    for warning in warnings or []:
+        print(f"placement: {warning}")
+
+
+def rank_cpus(plan, rank):
+    return plan["master"] if rank == 0 else plan["workers"][rank - 1]
@@ -0,0 +1,88 @@
+r"""
+Move the cut between two live LayerStages when one of them has become the
+bottleneck, e.g. because its core slowed down on a shared host.
+
+The master feeds every step's bubble_analyzer result to ``observe``. Once a
+window of steps has been seen, the per-micro-batch compute of each stage is
+averaged; if the slowest stage is more than ``threshold`` (relative) slower
+than its lighter neighbour, boundary layers move from it to that neighbour,
+parameters and optimizer state included. The RPC group and the stage
+objects stay as they are; only the DistributedOptimizer is rebuilt, since
+its per-worker parameter lists change.
+"""
+import torch
+from torch.distributed.optim import DistributedOptimizer
+
+from bubble_analyzer import suggest_cut
+
+
+class Rebalancer(object):
+    def __init__(self, pipeline, optimizer_class, window=3, threshold=0.2, cost_table=None, **optim_kwargs):
+        self.pipeline = pipeline
+        self.optimizer_class = optimizer_class
+        self.optim_kwargs = optim_kwargs
+        self.window = window
+        self.threshold = threshold
+        self.cost_table = cost_table
+        self.stages = pipeline.stage_rrefs()
+        self.cuts = torch.futures.wait_all([s.rpc_async().layer_range() for s in self.stages])
+        self._seen = []
+
+    def observe(self, analysis):
+        self._seen.append([s["per_micro_batch"] for s in analysis["stages"]])
+
+    def due(self):
+        return len(self._seen) >= self.window
+
+    def plan(self):
+        r"""
+        The move the last window calls for, or None: (slow stage, neighbour,
+        number of layers).
+        """
+        per_mb = [sum(col) / len(col) for col in zip(*self._seen)]
+        self._seen = []
+        suggestion = suggest_cut([{"per_micro_batch": t} for t in per_mb])
+        if suggestion is None:
+            return None
+        b, n = suggestion["bottleneck"], suggestion["neighbour"]
+        if suggestion["imbalance"] <= self.threshold * per_mb[b]:
+            return None
+
+        start, end = self.cuts[b]
+        if end - start < 2:
+            return None
+        if self.cost_table is not None:
+            from layer_profiler import layers_to_move
+            moved, _ = layers_to_move(self.cost_table, self.cuts, suggestion)
+            k = len(moved)
+        else:
+            # without a cost table, assume the stage's layers cost the same
+            k = round(suggestion["target_shift"] / (per_mb[b] / (end - start)))
+        k = max(1, min(k, end - start - 1))
+        return b, n, k
+
+    def rebalance(self, opt):
+        r"""
+        Apply the planned move, if any, and return the optimizer to use from
+        now on (``opt`` itself when nothing moved).
+        """
+        move = self.plan()
+        if move is None:
+            return opt
+        b, n, k = move
+        side = "back" if n > b else "front"
+
+        optims = self._stage_optims(opt)
+        torch.futures.wait_all([s.rpc_async().stash_optimizer_state(o) for s, o in zip(self.stages, optims)])
+        self.stages[b].rpc_sync().migrate_to(self.stages[n], side, k)
+        self.cuts = torch.futures.wait_all([s.rpc_async().layer_range() for s in self.stages])
+
+        opt = DistributedOptimizer(self.optimizer_class, self.pipeline.parameter_rrefs(), **self.optim_kwargs)
+        optims = self._stage_optims(opt)
+        torch.futures.wait_all([s.rpc_async().load_optimizer_state(o) for s, o in zip(self.stages, optims)])
+        print(f"rebalance: moved {k} layer(s) from stage {b} to stage {n}, cuts now {self.cuts}")
+        return opt
+
+    def _stage_optims(self, opt):
+        optims = {o.owner().name: o for o in opt.remote_optimizers}
+        return [optims[s.owner().name] for s in self.stages]
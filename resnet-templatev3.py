@@ -1,7 +1,7 @@
-import os
-import threading
 import time
-from functools import wraps
+startup_t0 = time.time()
+
+import os
 
 import torch
 import torch.nn as nn
@@ -10,16 +10,18 @@ import torch.distributed.rpc as rpc
 import torch.multiprocessing as mp
 import torch.optim as optim
 from torch.distributed.optim import DistributedOptimizer
-from torch.distributed.rpc import RRef
+
+from pipeline import DistPipeline
+from stage_base import StageBase
+from startup import StartupTimer
 
 
 num_classes = 1000
 
 
-class Stage0(torch.nn.Module):
-    def __init__(self):
-        super(Stage0, self).__init__()
-        self._lock = threading.Lock()
+class Stage0(StageBase):
+    def __init__(self, **options):
+        super(Stage0, self).__init__(**options)
         self.layer2 = torch.nn.Conv2d(3, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False)
         self.layer3 = torch.nn.BatchNorm2d(64, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
         self.layer4 = torch.nn.ReLU(inplace=True)
@@ -52,15 +54,15 @@ class Stage0(torch.nn.Module):
         self.layer33 = torch.nn.ReLU(inplace=True)
         self.layer34 = torch.nn.Conv2d(64, 256, kernel_size=(1, 1), stride=(1, 1), bias=False)
         self.layer35 = torch.nn.BatchNorm2d(256, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
-        self._initialize_weights()
+        self.finish_init()
 
 
-    def forward(self, x_rref):
+    def forward(self, x_rref, mb=None):
         tik = time.time()
         print(tik)
 
-        x = x_rref.to_here().to("cpu")
-        with self._lock:
+        x = self.receive(x_rref, mb)
+        with self.micro_batch(x) as mb_scope:
             out2 = self.layer2(x)
             out3 = self.layer3(out2)
             out4 = self.layer4(out3)
@@ -96,6 +98,7 @@ class Stage0(torch.nn.Module):
             out34 = self.layer34(out33)
             out35 = self.layer35(out34)
             out35 = out35 + out27
+            out35 = mb_scope.keep(out35)
 
         tok = time.time()
 
@@ -110,19 +113,10 @@ class Stage0(torch.nn.Module):
                 torch.nn.init.constant_(m.weight, 1)
                 torch.nn.init.constant_(m.bias, 0)
 
-    def parameter_rrefs(self):
-        r"""
-        Create one RRef for each parameter in the given local module, and return a
-        list of RRefs.
-        """
-        return [RRef(p) for p in self.parameters()]
-
-
-class Stage1(torch.nn.Module):
-    def __init__(self):
-        super(Stage1, self).__init__()
-        self._lock = threading.Lock()
 
+class Stage1(StageBase):
+    def __init__(self, **options):
+        super(Stage1, self).__init__(**options)
         self.layer37 = torch.nn.ReLU(inplace=True)
         self.layer38 = torch.nn.Conv2d(256, 512, kernel_size=(1, 1), stride=(2, 2), bias=False)
         self.layer39 = torch.nn.BatchNorm2d(512, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
@@ -172,15 +166,15 @@ class Stage1(torch.nn.Module):
         self.layer21 = torch.nn.BatchNorm2d(1024, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
         self.layer22 = torch.nn.Conv2d(512, 1024, kernel_size=(1, 1), stride=(2, 2), bias=False)
         self.layer23 = torch.nn.BatchNorm2d(1024, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
-        self._initialize_weights()
+        self.finish_init()
     
 
-    def forward(self, x_rref):
+    def forward(self, x_rref, mb=None):
         tik = time.time()
         print(tik)
 
-        x = x_rref.to_here().to("cpu")
-        with self._lock:
+        x = self.receive(x_rref, mb)
+        with self.micro_batch(x) as mb_scope:
             out37 = self.layer37(x)
             out38 = self.layer38(out37)
             out39 = self.layer39(out38)
@@ -235,6 +229,7 @@ class Stage1(torch.nn.Module):
             out22 = self.layer22(out13)
             out23 = self.layer23(out22)
             out23 = out23 + out21
+            out23 = mb_scope.keep(out23)
 
 
         tok = time.time()
@@ -255,19 +250,10 @@ class Stage1(torch.nn.Module):
                 torch.nn.init.normal_(m.weight, 0, 0.01)
                 torch.nn.init.constant_(m.bias, 0)
 
-    def parameter_rrefs(self):
-        r"""
-        Create one RRef for each parameter in the given local module, and return a
-        list of RRefs.
-        """
-        return [RRef(p) for p in self.parameters()]
-
-
-class Stage2(torch.nn.Module):
-    def __init__(self):
-        super(Stage2, self).__init__()
-        self._lock = threading.Lock()
 
+class Stage2(StageBase):
+    def __init__(self, **options):
+        super(Stage2, self).__init__(**options)
         self.layer25 = torch.nn.ReLU(inplace=True)
         self.layer26 = torch.nn.Conv2d(1024, 256, kernel_size=(1, 1), stride=(1, 1), bias=False)
         self.layer27 = torch.nn.BatchNorm2d(256, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
@@ -299,14 +285,14 @@ class Stage2(torch.nn.Module):
 
         self.layer53 = torch.nn.BatchNorm2d(1024, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
 
-        self._initialize_weights()
+        self.finish_init()
 
-    def forward(self, x_rref):
+    def forward(self, x_rref, mb=None):
         tik = time.time()
         print(tik)
         
-        x = x_rref.to_here().to("cpu")
-        with self._lock:
+        x = self.receive(x_rref, mb)
+        with self.micro_batch(x) as mb_scope:
             out25 = self.layer25(out23)
             out26 = self.layer26(out25)
             out27 = self.layer27(out26)
@@ -337,6 +323,7 @@ class Stage2(torch.nn.Module):
             out52 = self.layer52(out51)
             out53 = self.layer53(out52)
             out54 = out53+out45
+            out54 = mb_scope.keep(out54)
 
         tok = time.time()
 
@@ -356,18 +343,10 @@ class Stage2(torch.nn.Module):
                 torch.nn.init.normal_(m.weight, 0, 0.01)
                 torch.nn.init.constant_(m.bias, 0)
 
-    def parameter_rrefs(self):
-        r"""
-        Create one RRef for each parameter in the given local module, and return a
-        list of RRefs.
-        """
-        return [RRef(p) for p in self.parameters()]
-
-class Stage3(torch.nn.Module):
-    def __init__(self):
-        super(Stage3, self).__init__()
-        self._lock = threading.Lock()
 
+class Stage3(StageBase):
+    def __init__(self, **options):
+        super(Stage3, self).__init__(**options)
         self.layer4 = torch.nn.ReLU(inplace=True)
         self.layer5 = torch.nn.Conv2d(1024, 256, kernel_size=(1, 1), stride=(1, 1), bias=False)
         self.layer6 = torch.nn.BatchNorm2d(256, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True)
@@ -418,14 +397,14 @@ class Stage3(torch.nn.Module):
         self.layer56 = torch.nn.ReLU(inplace=True)
         self.layer57 = torch.nn.AvgPool2d(kernel_size=7, stride=1, padding=0)
         self.layer60 = torch.nn.Linear(in_features=8192, out_features=1000, bias=True)
-        self._initialize_weights()
+        self.finish_init()
 
-    def forward(self, x_rref):
+    def forward(self, x_rref, mb=None):
         tik = time.time()
         print(tik)
 
-        x = x_rref.to_here().to("cpu")
-        with self._lock:
+        x = self.receive(x_rref, mb)
+        with self.micro_batch(x) as mb_scope:
             out4 = self.layer4(x)
             out5 = self.layer5(out4)
             out6 = self.layer6(out5)
@@ -483,6 +462,7 @@ class Stage3(torch.nn.Module):
             out58 = out57.size(0)
             out59 = out57.view(out58, -1)
             out60 = self.layer60(out59)
+            out60 = mb_scope.keep(out60)
         
         tok = time.time()
 
@@ -503,78 +483,25 @@ class Stage3(torch.nn.Module):
                 torch.nn.init.normal_(m.weight, 0, 0.01)
                 torch.nn.init.constant_(m.bias, 0)
 
-    def parameter_rrefs(self):
-        r"""
-        Create one RRef for each parameter in the given local module, and return a
-        list of RRefs.
-        """
-        return [RRef(p) for p in self.parameters()]
 
+stage_classes = [Stage0, Stage1, Stage2, Stage3]
 
-class DistResNet(nn.Module):
+
+class DistResNet(DistPipeline):
     """
-    Assemble two parts as an nn.Module and define pipelining logic
+    Assemble the stages as an nn.Module and define pipelining logic
     """
-    def __init__(self, split_size, workers, *args, **kwargs):
-        super(DistResNet, self).__init__()
-
-        self.split_size = split_size
-
-        # Put the first stage on workers[0]
-        self.p1_rref = rpc.remote(
-            workers[0],
-            Stage0,
-            args = args,
-            kwargs = kwargs,
-            timeout=0
-        )
-        # Put the second stage on workers[1]
-        self.p2_rref = rpc.remote(
-            workers[1],
-            Stage1,
-            args = args,
-            kwargs = kwargs,
-            timeout=0
+    def __init__(self, split_size, workers, *args, prefetch_depth=None, await_snapshot=False, max_in_flight=None,
+                 **kwargs):
+        # Put stage i on workers[i]
+        super(DistResNet, self).__init__(
+            split_size,
+            workers,
+            [(stage, args, kwargs) for stage in stage_classes],
+            prefetch_depth,
+            await_snapshot,
+            max_in_flight
         )
-        # Put the third stage on workers[2]
-        self.p3_rref = rpc.remote(
-            workers[2],
-            Stage2,
-            args = args,
-            kwargs = kwargs,
-            timeout=0
-        )
-        # Put the fourth stage on workers[3]
-        self.p4_rref = rpc.remote(
-            workers[3],
-            Stage3,
-            args = args,
-            kwargs = kwargs,
-            timeout=0
-        )
-
-    def forward(self, xs):
-        # Split the input batch xs into micro-batches, and collect async RPC
-        # futures into a list
-        out_futures = []
-        for x in iter(xs.split(self.split_size, dim=0)):
-            input_rref = RRef(x)
-            p1_out_rref = self.p1_rref.remote().forward(input_rref)
-            p2_out_rref = self.p2_rref.remote().forward(p1_out_rref)
-            p3_out_rref = self.p3_rref.remote().forward(p2_out_rref)
-            out_fut = self.p4_rref.rpc_async().forward(p3_out_rref)
-            out_futures.append(out_fut)
-
-        # collect and cat all output tensors into one tensor.
-        return torch.cat(torch.futures.wait_all(out_futures))
-
-    def parameter_rrefs(self):
-        remote_params = []
-        remote_params.extend(self.p1_rref.remote().parameter_rrefs().to_here())
-        remote_params.extend(self.p2_rref.remote().parameter_rrefs().to_here())
-        remote_params.extend(self.p3_rref.remote().parameter_rrefs().to_here())
-        remote_params.extend(self.p4_rref.remote().parameter_rrefs().to_here())
-        return remote_params
 
 
 #########################################################
@@ -586,23 +513,100 @@ batch_size = 1
 image_w = 256
 image_h = 256
 
-
-def run_master(split_size):
+# write a sharded checkpoint every checkpoint_every batches, resuming from
+# the newest one found in checkpoint_dir
+checkpoint_dir = None
+checkpoint_every = 1
+
+# map stage weights from a cached snapshot instead of initialising them
+weight_snapshot_dir = None
+
+# pull up to prefetch_depth micro-batch inputs ahead of the one computing
+# (1 double-buffers; None pulls every input as soon as it is sent)
+prefetch_depth = 1
+
+# let at most max_in_flight micro-batches into the pipeline at once; the
+# master sends the next one when the oldest comes out (None sends them all)
+max_in_flight = 2 * len(stage_classes)
+
+# data parallelism: num_replicas copies of the pipeline on disjoint workers,
+# each taking a shard of the batch, with gradients all-reduced between them
+num_replicas = 1
+
+# "dist_autograd" runs one distributed backward from the master; "explicit"
+# has each stage run its own backward per micro-batch in ``schedule`` order
+# and send the gradient of its input to the previous stage, over ``transport``
+# ("rpc" or "p2p"). Explicit backward runs a single replica, without
+# checkpoints.
+backward_mode = "dist_autograd"
+schedule = "1f1b"
+transport = "rpc"
+
+# serving mode: split_size is the largest micro-batch the batcher may form
+mode = "train"  # "train", "infer" or "slo"
+p99_target = 0.5
+max_wait = 0.005
+num_requests = 256
+request_rate = 64
+
+
+def run_master(split_size, workers, timer=None):
+    from bubble_analyzer import analyze, print_analysis
+    from hybrid import HybridPipeline, replica_workers
+    from pipeline_sim import print_validation
+    from stage_memory import optimizer_state_bytes, print_memory_report
 
     # put the two model parts on worker1 and worker2 respectively
-    model = DistResNet(split_size, ["worker1", "worker2", "worker3", "worker4"])
+    model = HybridPipeline([
+        DistResNet(split_size, ws, prefetch_depth=prefetch_depth, await_snapshot=weight_snapshot_dir is not None,
+                   max_in_flight=max_in_flight)
+        for ws in replica_workers(workers, num_replicas)
+    ])
     loss_fn = nn.MSELoss()
-    opt = DistributedOptimizer(
-        optim.SGD,
-        model.parameter_rrefs(),
-        lr=0.05,
-    )
+    trainer = None
+    if backward_mode == "explicit":
+        from schedule import ScheduledPipeline
+
+        # each worker gets a local optimizer over its stage's parameters
+        trainer = ScheduledPipeline(model.replicas[0], schedule, optim.SGD, loss_fn, transport, lr=0.05)
+    else:
+        opt = DistributedOptimizer(
+            optim.SGD,
+            model.parameter_rrefs(),
+            lr=0.05,
+        )
+    if weight_snapshot_dir is not None:
+        from weight_snapshot import load_or_create
+
+        load_or_create(model.replicas[0].stage_rrefs(), weight_snapshot_dir, "resnet")
+    model.wait_ready()
+    if timer is not None:
+        timer.mark("stage construct")
+
+    ckpt = None
+    start = 0
+    if checkpoint_dir is not None:
+        from checkpoint import CheckpointManager
+
+        ckpt = CheckpointManager(model.stage_rrefs(), opt, checkpoint_dir)
+        restored = ckpt.restore()
+        if restored is not None:
+            start = restored + 1
+            print(f"Resumed from checkpoint at batch {restored}")
 
     one_hot_indices = torch.LongTensor(batch_size) \
                            .random_(0, num_classes) \
                            .view(batch_size, 1)
 
-    for i in range(num_batches):
+    if trainer is not None and transport == "p2p":
+        # the first step of a batch layout goes over RPC to record receive
+        # shapes; run it untimed so the timed steps use isend/irecv
+        trainer.train_step(torch.randn(batch_size, 3, image_w, image_h),
+                           torch.zeros(batch_size, num_classes).scatter_(1, one_hot_indices, 1))
+        # drop its timings so the analysis covers the timed steps only
+        model.timings()
+
+    for i in range(start, num_batches):
         print(f"Processing batch {i}")
         # generate random inputs and labels
         inputs = torch.randn(batch_size, 3, image_w, image_h)
@@ -612,23 +616,75 @@ def run_master(split_size):
         # The distributed autograd context is the dedicated scope for the
         # distributed backward pass to store gradients, which can later be
         # retrieved using the context_id by the distributed optimizer.
-        with dist_autograd.context() as context_id:
-            outputs = model(inputs)
-            dist_autograd.backward(context_id, [loss_fn(outputs, labels)])
-            opt.step(context_id)
-
-
-def run_worker(rank, world_size, split_size):
+        model.memory_begin()
+        tik = time.time()
+        if trainer is not None:
+            print(f"{schedule} loss: {trainer.train_step(inputs, labels)}")
+        else:
+            with dist_autograd.context() as context_id:
+                outputs = model(inputs)
+                dist_autograd.backward(context_id, [loss_fn(outputs, labels)])
+                model.allreduce_gradients(context_id)
+                opt.step(context_id)
+        tok = time.time()
+        if timer is not None and i == start:
+            timer.mark("first step")
+            timer.report("master")
+        if ckpt is not None and (i + 1) % checkpoint_every == 0:
+            ckpt.save(i)
+        state_bytes = trainer.optimizer_state_bytes() if trainer is not None else optimizer_state_bytes(opt)
+        print_memory_report(model.memory_reports(), state_bytes, tok - tik)
+        replica_timings = model.timings()
+        for r, timings in enumerate(replica_timings):
+            if len(replica_timings) > 1:
+                print(f"replica {r}:")
+            print_analysis(analyze(timings, tik, split_size=split_size))
+        # distributed autograd runs every forward, then one backward: GPipe.
+        # The replicas run the same schedule, so replica 0 is replayed.
+        print_validation(replica_timings[0], tok - tik, schedule if trainer is not None else "gpipe")
+
+    if ckpt is not None:
+        ckpt.wait()
+
+
+def run_inference(max_batch_size, workers):
+    from inference import InferencePipeline, serve_benchmark
+
+    model = DistResNet(max_batch_size, workers)
+    pipeline = InferencePipeline(model.stage_rrefs(), max_batch_size=max_batch_size, max_wait=max_wait)
+    stats = serve_benchmark(pipeline, (3, image_w, image_h), num_requests, request_rate)
+    pipeline.close()
+    print(f"inference (max batch {max_batch_size}): {stats}")
+    for i, pool_stats in enumerate(model.buffer_stats()):
+        print(f"stage{i} buffer pool: {pool_stats}")
+
+
+def run_slo_inference(max_batch_size, workers):
+    from slo_scheduler import SloPipeline, slo_benchmark
+
+    model = DistResNet(max_batch_size, workers)
+    pipeline = SloPipeline(model.stage_rrefs(), p99_target, max_batch_size=max_batch_size)
+    metrics = slo_benchmark(pipeline, (3, image_w, image_h), num_requests, request_rate)
+    pipeline.close()
+    print(f"slo inference (p99 target {p99_target}s): {metrics}")
+
+
+def run_worker(rank, world_size, split_size, plan):
+    timer = StartupTimer(startup_t0)
+    timer.mark("import")
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = '29500'
     options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=256, rpc_timeout=1200)
 
     import psutil
+    from placement import rank_cpus
     p = psutil.Process()
     
     if rank == 0:
-        p.cpu_affinity([0])
-        print(f"Child #{rank}: Set my affinity to {rank}, affinity now {p.cpu_affinity()}", flush=True)
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
 
         rpc.init_rpc(
             "master",
@@ -636,10 +692,27 @@ def run_worker(rank, world_size, split_size):
             world_size=world_size,
             rpc_backend_options=options
         )
-        run_master(split_size)
+        timer.mark("init_rpc")
+        if num_replicas > 1:
+            from hybrid import init_replica_groups
+
+            init_replica_groups(rank, world_size, num_replicas)
+        if backward_mode == "explicit" and transport == "p2p":
+            from p2p_transport import init_p2p
+
+            init_p2p(rank, world_size)
+        workers = [f"worker{r}" for r in range(1, world_size)]
+        if mode == "infer":
+            run_inference(split_size, workers)
+        elif mode == "slo":
+            run_slo_inference(split_size, workers)
+        else:
+            run_master(split_size, workers, timer)
     else:
-        p.cpu_affinity([rank-1])
-        print(f"Child #{rank}: Set my affinity to {rank}, affinity now {p.cpu_affinity()}", flush=True)
+        if plan is not None:
+            p.cpu_affinity(rank_cpus(plan, rank))
+        cpus = rank_cpus(plan, rank) if plan is not None else "unpinned"
+        print(f"Child #{rank}: placement {cpus}, affinity now {p.cpu_affinity()}", flush=True)
 
         rpc.init_rpc(
             f"worker{rank}",
@@ -647,15 +720,37 @@ def run_worker(rank, world_size, split_size):
             world_size=world_size,
             rpc_backend_options=options
         )
-        pass
+        timer.mark("init_rpc")
+        if num_replicas > 1:
+            from hybrid import init_replica_groups
+
+            init_replica_groups(rank, world_size, num_replicas)
+        if backward_mode == "explicit" and transport == "p2p":
+            from p2p_transport import init_p2p
+
+            init_p2p(rank, world_size)
+        timer.report(f"worker{rank}")
 
     # block until all rpcs finish
     rpc.shutdown()
 
 
 if __name__=="__main__":
-    world_size = 5
+    from placement import plan_placement, print_plan, validate_plan
+
+    if backward_mode == "explicit" and (num_replicas > 1 or checkpoint_dir is not None):
+        raise ValueError("explicit backward runs one replica, without checkpoints")
+    # the master plus one worker per stage of every replica
+    world_size = num_replicas * len(stage_classes) + 1
+    # give the master and every worker their own cores, checked before spawning
+    plan = plan_placement(world_size - 1)
+    try:
+        print_plan(plan, warnings=validate_plan(plan))
+    except ValueError as e:
+        # too few CPUs for one per rank: run unpinned rather than not at all
+        print(f"placement: {e}, running without CPU affinity")
+        plan = None
     tik = time.time()
-    mp.spawn(run_worker, args=(world_size, 1), nprocs=world_size, join=True)
+    mp.spawn(run_worker, args=(world_size, 1, plan), nprocs=world_size, join=True)
     tok = time.time()
     print(f"execution time = {tok - tik}")
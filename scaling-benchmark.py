@@ -0,0 +1,174 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed.autograd as dist_autograd
+import torch.distributed.rpc as rpc
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.distributed.optim import DistributedOptimizer
+
+from model_layers import KAIMING_INIT, build_layers, initialize_weights, num_layers
+from pipeline import DistLayerPipeline
+
+num_classes = 1000
+
+
+#########################################################
+#                      Benchmark                        #
+#########################################################
+
+# run each model (a) unpartitioned in one process with N threads and (b)
+# pipelined over N single-core workers, and compare both against the
+# one-process, one-thread time
+models = {
+    "alexnet": (128, 128),
+    "vgg": (128, 128),
+    "resnet": (256, 256),
+}
+core_counts = [1, 2, 4, 8]
+num_batches = 3
+warmup_batches = 1
+batch_size = 128
+split_size = 8
+results_csv = "scaling_results.csv"
+
+
+def make_batch(image_w, image_h):
+    one_hot_indices = torch.LongTensor(batch_size) \
+                           .random_(0, num_classes) \
+                           .view(batch_size, 1)
+    inputs = torch.randn(batch_size, 3, image_w, image_h)
+    labels = torch.zeros(batch_size, num_classes) \
+                  .scatter_(1, one_hot_indices, 1)
+    return inputs, labels
+
+
+def run_single(rank, model_name, image_w, image_h, num_threads, results):
+    import psutil
+    psutil.Process().cpu_affinity(list(range(num_threads)))
+    torch.set_num_threads(num_threads)
+
+    n = num_layers(model_name, image_w=image_w, image_h=image_h, num_classes=num_classes)
+    model = nn.Sequential(*build_layers(model_name, 0, n, image_w=image_w, image_h=image_h, num_classes=num_classes))
+    if model_name in KAIMING_INIT:
+        initialize_weights(model)
+    loss_fn = nn.MSELoss()
+    opt = optim.SGD(model.parameters(), lr=0.05)
+    inputs, labels = make_batch(image_w, image_h)
+
+    times = []
+    for i in range(warmup_batches + num_batches):
+        tik = time.time()
+        opt.zero_grad()
+        loss_fn(model(inputs), labels).backward()
+        opt.step()
+        if i >= warmup_batches:
+            times.append(time.time() - tik)
+
+    results.put({"step_time": min(times), "bubble": None})
+
+
+def run_pipeline_master(model_name, image_w, image_h, workers, results):
+    model = DistLayerPipeline(model_name, split_size, workers,
+                              image_w=image_w, image_h=image_h, num_classes=num_classes)
+    loss_fn = nn.MSELoss()
+    opt = DistributedOptimizer(
+        optim.SGD,
+        model.parameter_rrefs(),
+        lr=0.05,
+    )
+    model.wait_ready()
+    inputs, labels = make_batch(image_w, image_h)
+
+    best = None
+    for i in range(warmup_batches + num_batches):
+        cpu_before = model.cpu_times()
+        tik = time.time()
+        with dist_autograd.context() as context_id:
+            outputs = model(inputs)
+            dist_autograd.backward(context_id, [loss_fn(outputs, labels)])
+            opt.step(context_id)
+        step = time.time() - tik
+        busy = [after - before for before, after in zip(cpu_before, model.cpu_times())]
+        if i >= warmup_batches and (best is None or step < best[0]):
+            best = (step, busy)
+
+    step, busy = best
+    # fraction of stage-time the workers were not computing
+    bubble = 1 - sum(min(b, step) for b in busy) / (len(busy) * step)
+    results.put({"step_time": step, "bubble": bubble})
+
+
+def run_pipeline_worker(rank, world_size, model_name, image_w, image_h, results):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=256, rpc_timeout=1200)
+
+    import psutil
+    p = psutil.Process()
+    ncores = os.cpu_count()
+    num_workers = world_size - 1
+    torch.set_num_threads(1)
+
+    if rank == 0:
+        # keep the master off the workers' cores when there is a spare one
+        p.cpu_affinity([num_workers % ncores])
+        rpc.init_rpc("master", rank=rank, world_size=world_size, rpc_backend_options=options)
+        workers = [f"worker{r}" for r in range(1, world_size)]
+        run_pipeline_master(model_name, image_w, image_h, workers, results)
+    else:
+        p.cpu_affinity([(rank - 1) % ncores])
+        rpc.init_rpc(f"worker{rank}", rank=rank, world_size=world_size, rpc_backend_options=options)
+
+    # block until all rpcs finish
+    rpc.shutdown()
+
+
+def measure(fn, args, nprocs):
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    mp.spawn(fn, args=args + (results,), nprocs=nprocs, join=True)
+    return results.get()
+
+
+def print_table(rows):
+    print(f"{'model':<10}{'mode':<10}{'cores':>6}{'step s':>10}{'speedup':>10}{'efficiency':>12}{'bubble':>10}")
+    for r in rows:
+        bubble = "" if r["bubble"] is None else f"{r['bubble']:.2f}"
+        print(f"{r['model']:<10}{r['mode']:<10}{r['cores']:>6}{r['step_time']:>10.3f}"
+              f"{r['speedup']:>10.2f}{r['efficiency']:>12.2f}{bubble:>10}")
+
+
+if __name__=="__main__":
+    rows = []
+    for model_name, (image_w, image_h) in models.items():
+        baseline = None
+        for cores in core_counts:
+            single = measure(run_single, (model_name, image_w, image_h, cores), 1)
+            if baseline is None:
+                baseline = single["step_time"]
+            configs = [("single", single)]
+            if cores > 1:
+                pipe = measure(run_pipeline_worker, (cores + 1, model_name, image_w, image_h), cores + 1)
+                configs.append(("pipeline", pipe))
+            for mode, r in configs:
+                speedup = baseline / r["step_time"]
+                rows.append({
+                    "model": model_name,
+                    "mode": mode,
+                    "cores": cores,
+                    "step_time": r["step_time"],
+                    "speedup": speedup,
+                    "efficiency": speedup / cores,
+                    "bubble": r["bubble"],
+                })
+        print_table([r for r in rows if r["model"] == model_name])
+
+    with open(results_csv, "w") as f:
+        f.write("model,mode,cores,step_time,speedup,efficiency,bubble\n")
+        for r in rows:
+            bubble = "" if r["bubble"] is None else r["bubble"]
+            f.write(f"{r['model']},{r['mode']},{r['cores']},{r['step_time']},"
+                    f"{r['speedup']},{r['efficiency']},{bubble}\n")
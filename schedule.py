@@ -0,0 +1,232 @@
+r"""
+The per-worker executor that runs pipeline schedules. Schedules are data,
+built in schedule_ops: for every worker, the ordered F/B/Step operations of
+one training step. Chunk ``c`` lives on worker ``c % num_workers``
+(DistPipeline's placement).
+
+The executor replaces distributed autograd with explicit messages: a
+forward sends its output to the executor owning the next chunk, a backward
+sends the gradient of its input back to the previous one, and each op waits
+for the message it depends on. The stages themselves are unchanged; the
+executor calls their usual ``forward`` with a local RRef.
+
+Messages go over RPC by default; with ``transport="p2p"`` they use
+torch.distributed isend/irecv after the first step (see p2p_transport).
+"""
+import threading
+
+import torch
+import torch.distributed.rpc as rpc
+from torch.distributed.rpc import RRef
+
+from p2p_transport import P2PTransport
+from schedule_ops import make_schedule
+
+
+class ScheduleExecutor(object):
+    r"""
+    Lives on one worker and runs that worker's op list over the chunks it
+    hosts. Activations and gradients arrive through ``deliver`` from the
+    neighbouring executors; each op blocks until the message it needs is in.
+    """
+    def __init__(self, chunk_rrefs, optimizer_class, loss_fn, **optim_kwargs):
+        # chunk id -> stage module; the RRefs are owned by this worker
+        self.chunks = {c: r.local_value() for c, r in chunk_rrefs.items()}
+        params = [p for stage in self.chunks.values() for p in stage.parameters()]
+        self.optim = optimizer_class(params, **optim_kwargs)
+        self.loss_fn = loss_fn
+        self.peers = None
+        self.num_chunks = None
+        self.master = None
+        self.transport = None
+        self._shapes = {}
+        self._inbox = {}
+        self._cv = threading.Condition()
+
+    def connect(self, peers, num_chunks, transport="rpc", master=None):
+        r"""
+        ``peers`` maps every chunk id to the RRef of the executor holding it.
+        For the p2p transport ``master`` is the rank feeding inputs and labels.
+        """
+        self.peers = peers
+        self.num_chunks = num_chunks
+        self.master = master
+        if transport == "p2p":
+            self.transport = P2PTransport(num_chunks)
+
+    def deliver(self, kind, chunk, mb, t):
+        with self._cv:
+            self._inbox[(kind, chunk, mb)] = t
+            if self.transport is not None:
+                self._shapes[(kind, chunk, mb)] = (t.shape, t.dtype)
+            self._cv.notify_all()
+
+    def _take(self, key, p2p=False):
+        if p2p and self.transport.posted(key):
+            return self.transport.take(key)
+        with self._cv:
+            self._cv.wait_for(lambda: key in self._inbox)
+            return self._inbox.pop(key)
+
+    def _send(self, kind, chunk, mb, t, p2p=False):
+        peer = self.peers[chunk]
+        if peer.is_owner():
+            self.deliver(kind, chunk, mb, t)
+        elif p2p:
+            self.transport.send(kind, chunk, mb, t, peer.owner().id)
+        else:
+            peer.rpc_async().deliver(kind, chunk, mb, t)
+
+    def _post(self, ops):
+        r"""
+        Post a receive for every message from another process that ``ops``
+        will wait on, with the shapes recorded during the RPC step.
+        """
+        last = self.num_chunks - 1
+
+        def post(kind, chunk, mb, src):
+            shape, dtype = self._shapes[(kind, chunk, mb)]
+            self.transport.post(kind, chunk, mb, src, shape, dtype)
+
+        for kind, c, mb in ops:
+            if kind == "F":
+                if c == 0:
+                    post("x", c, mb, self.master)
+                elif not self.peers[c - 1].is_owner():
+                    post("x", c, mb, self.peers[c - 1].owner().id)
+                if c == last:
+                    post("y", c, mb, self.master)
+            elif kind == "B" and c < last and not self.peers[c + 1].is_owner():
+                post("g", c, mb, self.peers[c + 1].owner().id)
+
+    def run(self, ops, batch_size, p2p=False):
+        r"""
+        Run one step's ops. Returns the summed loss of the micro-batches whose
+        last chunk is here (0 elsewhere). ``p2p`` moves this step's messages
+        over the point-to-point transport; the master only sets it once a
+        step with the same layout has run over RPC.
+        """
+        if p2p:
+            self._post(ops)
+        saved = {}
+        loss_total = 0.0
+        for kind, c, mb in ops:
+            if kind == "F":
+                x = self._take(("x", c, mb), p2p)
+                if c > 0:
+                    # detach so a pooled receive buffer stays a plain tensor
+                    x = x.detach().requires_grad_(True)
+                out = self.chunks[c].forward(RRef(x), mb)
+                if c == self.num_chunks - 1:
+                    y = self._take(("y", c, mb), p2p)
+                    # weight by micro-batch size so the sum is the batch mean
+                    out = self.loss_fn(out, y) * (y.size(0) / batch_size)
+                    loss_total += out.item()
+                else:
+                    self._send("x", c + 1, mb, out.detach(), p2p)
+                saved[(c, mb)] = (x, out)
+            elif kind == "B":
+                x, out = saved.pop((c, mb))
+                if c == self.num_chunks - 1:
+                    out.backward()
+                else:
+                    out.backward(self._take(("g", c, mb), p2p))
+                if c > 0:
+                    self._send("g", c - 1, mb, x.grad, p2p)
+                if p2p:
+                    self.transport.release(c, mb)
+            else:
+                self.optim.step()
+                self.optim.zero_grad(set_to_none=True)
+        if p2p:
+            self.transport.flush()
+        return loss_total
+
+    def optimizer_state_bytes(self):
+        total = 0
+        for state in self.optim.state.values():
+            for v in state.values():
+                if isinstance(v, torch.Tensor):
+                    total += v.numel() * v.element_size()
+        return total
+
+
+class ScheduledPipeline(object):
+    r"""
+    Train a DistPipeline under an explicit schedule instead of one
+    distributed autograd pass. Each worker gets a ScheduleExecutor over the
+    chunks it hosts and a local optimizer over their parameters.
+
+    ``transport`` is "rpc" or "p2p"; the latter needs ``init_p2p`` on every
+    process.
+    """
+    def __init__(self, pipeline, schedule, optimizer_class, loss_fn, transport="rpc", **optim_kwargs):
+        self.pipeline = pipeline
+        self.schedule = schedule
+        self.transport = P2PTransport(0) if transport == "p2p" else None
+        # batch layout the executors have recorded receive shapes for
+        self._probed = None
+        self.workers = pipeline.workers
+        chunks = pipeline.stage_rrefs()
+        self.num_chunks = len(chunks)
+        if self.num_chunks % len(self.workers) != 0:
+            raise ValueError(f"{self.num_chunks} chunks cannot be spread evenly over {len(self.workers)} workers")
+        self.chunks_per_worker = self.num_chunks // len(self.workers)
+
+        self.executors = [
+            rpc.remote(
+                worker,
+                ScheduleExecutor,
+                args=({c: r for c, r in enumerate(chunks) if c % len(self.workers) == w}, optimizer_class, loss_fn),
+                kwargs=optim_kwargs
+            )
+            for w, worker in enumerate(self.workers)
+        ]
+        peers = {c: self.executors[c % len(self.workers)] for c in range(self.num_chunks)}
+        if self.transport is not None:
+            self.transport.num_chunks = self.num_chunks
+        master = rpc.get_worker_info().id
+        torch.futures.wait_all([
+            e.rpc_async().connect(peers, self.num_chunks, transport, master) for e in self.executors
+        ])
+
+    def train_step(self, inputs, labels):
+        r"""
+        One forward, backward and optimizer step over the batch. Returns the
+        mean loss.
+        """
+        self.pipeline.begin_step()
+        xs = inputs.split(self.pipeline.split_size, dim=0)
+        ys = labels.split(self.pipeline.split_size, dim=0)
+        ops = make_schedule(self.schedule, len(self.workers), len(xs), self.chunks_per_worker)
+
+        first = self.executors[0]
+        last = self.executors[(self.num_chunks - 1) % len(self.workers)]
+        layout = [x.size(0) for x in xs]
+        p2p = self.transport is not None and layout == self._probed
+
+        feeds = []
+        for mb, (x, y) in enumerate(zip(xs, ys)):
+            if p2p:
+                self.transport.send("x", 0, mb, x, first.owner().id)
+                self.transport.send("y", self.num_chunks - 1, mb, y, last.owner().id)
+            else:
+                feeds.append(first.rpc_async().deliver("x", 0, mb, x))
+                feeds.append(last.rpc_async().deliver("y", self.num_chunks - 1, mb, y))
+        torch.futures.wait_all(feeds)
+
+        losses = torch.futures.wait_all([
+            e.rpc_async().run(worker_ops, inputs.size(0), p2p) for e, worker_ops in zip(self.executors, ops)
+        ])
+        if p2p:
+            self.transport.flush()
+        self._probed = layout
+        return sum(losses)
+
+    def optimizer_state_bytes(self):
+        r"""
+        Bytes of state in each worker's local optimizer, keyed by worker name
+        like ``stage_memory.optimizer_state_bytes``.
+        """
+        sizes = torch.futures.wait_all([e.rpc_async().optimizer_state_bytes() for e in self.executors])
+        return dict(zip(self.workers, sizes))
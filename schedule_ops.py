@@ -0,0 +1,142 @@
+r"""
+Pipeline schedules as data. A schedule gives every worker the ordered list
+of operations it performs in one training step:
+
+    F(mb, chunk)    forward of micro-batch ``mb`` through ``chunk``
+    B(mb, chunk)    backward of it
+    Step()          local optimizer step, once this worker's backwards are done
+
+Chunk ``c`` lives on worker ``c % num_workers``. A schedule is any callable
+(num_workers, num_micro_batches, chunks_per_worker) -> per-worker op lists;
+GPipe, 1F1B and interleaved 1F1B are built in.
+
+Nothing here needs torch, so the simulator and the partitioner can build
+schedules on a machine without it; schedule.py runs them.
+"""
+
+
+def F(mb, chunk):
+    return ("F", chunk, mb)
+
+
+def B(mb, chunk):
+    return ("B", chunk, mb)
+
+
+def Step():
+    return ("S", None, None)
+
+
+def gpipe(num_workers, num_micro_batches, chunks_per_worker=1):
+    r"""
+    All forwards, then all backwards (GPipe with a flush), the order the
+    Dist* pipelines run in today.
+    """
+    p, v, m = num_workers, chunks_per_worker, num_micro_batches
+    last = p * v - 1
+    schedule = []
+    for rank in range(p):
+        chunks = [local * p + rank for local in range(v)]
+        # with several chunks per worker, run operations in the order their
+        # inputs can arrive, as the RPC handlers would
+        forward = sorted(((c, mb) for mb in range(m) for c in chunks), key=lambda o: (o[0] + o[1], -o[0]))
+        backward = sorted(((c, mb) for mb in range(m) for c in chunks), key=lambda o: (last - o[0] + o[1], o[0]))
+        schedule.append([F(mb, c) for c, mb in forward] + [B(mb, c) for c, mb in backward] + [Step()])
+    return schedule
+
+
+def one_f_one_b(num_workers, num_micro_batches, chunks_per_worker=1):
+    r"""
+    PipeDream-flush 1F1B: worker ``r`` runs ``p - r - 1`` warm-up forwards,
+    then alternates one forward and one backward, then drains.
+    """
+    if chunks_per_worker != 1:
+        raise ValueError("1f1b runs one chunk per worker; use interleaved")
+    p, m = num_workers, num_micro_batches
+    schedule = []
+    for rank in range(p):
+        warmup = min(p - rank - 1, m)
+        ops = [F(mb, rank) for mb in range(warmup)]
+        for i in range(m - warmup):
+            ops.append(F(warmup + i, rank))
+            ops.append(B(i, rank))
+        ops += [B(mb, rank) for mb in range(m - warmup, m)]
+        schedule.append(ops + [Step()])
+    return schedule
+
+
+def interleaved_1f1b(num_workers, chunks_per_worker, num_micro_batches):
+    r"""
+    Per-worker operation order for the interleaved 1F1B schedule (Narayanan
+    et al., 2021). Worker ``r`` holds chunks ``r, r + p, r + 2p, ...``; each
+    entry is ("F" or "B", global chunk index, micro-batch).
+
+    Micro-batches go through a worker's chunks in groups of ``p``, so the
+    first backward can start after ``(p - r - 1) * 2 + (v - 1) * p`` forwards
+    instead of ``m``, and the fill/drain bubble shrinks by a factor of ``v``.
+    """
+    p, v, m = num_workers, chunks_per_worker, num_micro_batches
+    if m % p != 0:
+        raise ValueError(f"interleaved schedule needs micro-batches ({m}) to be a multiple of workers ({p})")
+
+    total = m * v
+
+    def mb_of(k):
+        return (k // (p * v)) * p + k % p
+
+    def chunk_of(rank, k, forward):
+        local = (k // p) % v
+        if not forward:
+            local = v - 1 - local
+        return local * p + rank
+
+    schedule = []
+    for rank in range(p):
+        warmup = min((p - rank - 1) * 2 + (v - 1) * p, total)
+        ops = [("F", chunk_of(rank, k, True), mb_of(k)) for k in range(warmup)]
+        for i in range(total - warmup):
+            k = warmup + i
+            ops.append(("F", chunk_of(rank, k, True), mb_of(k)))
+            ops.append(("B", chunk_of(rank, i, False), mb_of(i)))
+        for i in range(total - warmup, total):
+            ops.append(("B", chunk_of(rank, i, False), mb_of(i)))
+        schedule.append(ops)
+    return schedule
+
+
+def interleaved(num_workers, num_micro_batches, chunks_per_worker=2):
+    return [ops + [Step()] for ops in interleaved_1f1b(num_workers, chunks_per_worker, num_micro_batches)]
+
+
+SCHEDULES = {
+    "gpipe": gpipe,
+    "1f1b": one_f_one_b,
+    "interleaved": interleaved,
+}
+
+
+def make_schedule(schedule, num_workers, num_micro_batches, chunks_per_worker=1):
+    r"""
+    Build per-worker op lists from a schedule name or callable, and check
+    that every chunk runs F and B for every micro-batch exactly once, on the
+    worker that holds it.
+    """
+    fn = SCHEDULES[schedule] if isinstance(schedule, str) else schedule
+    ops = fn(num_workers, num_micro_batches, chunks_per_worker)
+    num_chunks = num_workers * chunks_per_worker
+
+    expected = {(k, c, mb) for k in "FB" for c in range(num_chunks) for mb in range(num_micro_batches)}
+    seen = set()
+    for rank, worker_ops in enumerate(ops):
+        for op in worker_ops:
+            kind, c, mb = op
+            if kind == "S":
+                continue
+            if op not in expected or op in seen:
+                raise ValueError(f"worker {rank}: unexpected or repeated operation {op}")
+            if c % num_workers != rank:
+                raise ValueError(f"worker {rank}: chunk {c} lives on worker {c % num_workers}")
+            seen.add(op)
+    if seen != expected:
+        raise ValueError(f"schedule is missing {sorted(expected - seen)[:4]}...")
+    return ops
@@ -0,0 +1,194 @@
+import random
+import time
+
+import torch
+
+from inference import InferencePipeline, _percentile
+
+
+class ServiceModel(object):
+    r"""
+    Per-stage service time as a function of micro-batch size, fitted from the
+    times the stages report. Each stage is modelled as ``a + c * b``; with
+    samples at only one batch size the cost is assumed to scale linearly,
+    which over-estimates larger batches rather than under-estimating them.
+    """
+    def __init__(self, num_stages, alpha=0.2):
+        self.alpha = alpha
+        self.samples = [dict() for _ in range(num_stages)]
+
+    def observe(self, stage, batch_size, seconds):
+        est = self.samples[stage]
+        if batch_size in est:
+            est[batch_size] = (1 - self.alpha) * est[batch_size] + self.alpha * seconds
+        else:
+            est[batch_size] = seconds
+
+    def known(self):
+        return all(self.samples)
+
+    def stage_time(self, stage, b):
+        est = self.samples[stage]
+        if not est:
+            return 0.0
+        if b in est:
+            return est[b]
+        if len(est) == 1:
+            (b0, t0), = est.items()
+            return t0 * b / b0
+        n = len(est)
+        mean_b = sum(est) / n
+        mean_t = sum(est.values()) / n
+        var = sum((k - mean_b) ** 2 for k in est)
+        c = sum((k - mean_b) * (v - mean_t) for k, v in est.items()) / var
+        a = mean_t - c * mean_b
+        return max(a + c * b, 0.0)
+
+    def latency(self, b):
+        return sum(self.stage_time(s, b) for s in range(len(self.samples)))
+
+    def bottleneck(self, b):
+        return max(self.stage_time(s, b) for s in range(len(self.samples)))
+
+
+class SloPipeline(InferencePipeline):
+    r"""
+    Inference pipeline that picks the micro-batch size per dispatch to meet a
+    p99 latency target.
+
+    Under light load the smallest batch keeps up with arrivals and gives the
+    lowest latency; as the arrival rate grows the batch size is raised until
+    the bottleneck stage's throughput covers it, as long as the predicted
+    latency still fits the target. Requests that cannot finish within the
+    target given the current queue are rejected at admission instead of
+    making everyone behind them late.
+    """
+    def __init__(self, stage_rrefs, p99_target, max_batch_size=32, headroom=0.8,
+                 poll_interval=0.1):
+        self.p99_target = p99_target
+        self.headroom = headroom
+        self.poll_interval = poll_interval
+        self.model = ServiceModel(len(stage_rrefs))
+        self.batch_limit = max_batch_size
+        self.rejected = 0
+        self.queue_depths = []
+        self._arrivals = []
+        self._last_poll = 0.0
+        self._poll = None
+        super(SloPipeline, self).__init__(stage_rrefs, max_batch_size=1, max_wait=0.0)
+
+    def submit(self, x):
+        now = time.time()
+        with self._lock:
+            self._arrivals.append(now)
+        if not self._admit():
+            fut = torch.futures.Future()
+            fut.set_exception(RuntimeError("request rejected: p99 target would be missed"))
+            with self._lock:
+                self.rejected += 1
+            return fut
+        return super(SloPipeline, self).submit(x)
+
+    def _admit(self):
+        if not self.model.known():
+            return True
+        depth = self._queue.qsize()
+        with self._lock:
+            b = self.max_batch_size
+        # requests ahead of this one drain in batches of b through the bottleneck
+        drain = (depth // b + 1) * self.model.bottleneck(b)
+        return drain + self.model.latency(b) <= self.p99_target
+
+    def arrival_rate(self, window=1.0):
+        now = time.time()
+        with self._lock:
+            self._arrivals = [t for t in self._arrivals if now - t <= window]
+            return len(self._arrivals) / window
+
+    def choose_batch_size(self):
+        if not self.model.known():
+            return 1, 0.0
+        rate = self.arrival_rate()
+        best = 1
+        for b in range(1, self.batch_limit + 1):
+            latency = self.model.latency(b)
+            fill = b / rate if rate > 0 else 0.0
+            if latency + fill > self.p99_target:
+                break
+            best = b
+            # a fitted time of 0 (negative intercept) means the stages
+            # keep up with any rate at this size
+            bottleneck = self.model.bottleneck(b)
+            if bottleneck <= 0 or b / bottleneck * self.headroom >= rate:
+                break
+        slack = self.p99_target - self.model.latency(best)
+        return best, max(0.0, min(slack / 2, best / rate if rate > 0 else 0.0))
+
+    def _next_batch(self):
+        self._refresh_service_times()
+        max_batch_size, max_wait = self.choose_batch_size()
+        depth = self._queue.qsize()
+        with self._lock:
+            self.max_batch_size, self.max_wait = max_batch_size, max_wait
+            self.queue_depths.append((time.time(), depth))
+        return super(SloPipeline, self)._next_batch()
+
+    def _refresh_service_times(self):
+        if self._poll is not None and self._poll.done():
+            for stage, times in enumerate(self._poll.wait()):
+                for b, seconds in times:
+                    self.model.observe(stage, b, seconds)
+            self._poll = None
+        now = time.time()
+        if self._poll is None and now - self._last_poll >= self.poll_interval:
+            self._last_poll = now
+            self._poll = torch.futures.collect_all(
+                [s.rpc_async().service_times() for s in self.stage_rrefs]
+            ).then(lambda f: [x.wait() for x in f.wait()])
+
+    def metrics(self):
+        stats = self.stats()
+        with self._lock:
+            depths = [d for _, d in self.queue_depths]
+            batch_size, max_wait = self.max_batch_size, self.max_wait
+        stats.update({
+            "rejected": self.rejected,
+            "batch_size": batch_size,
+            "max_wait": max_wait,
+            "queue_depth_mean": sum(depths) / len(depths) if depths else 0.0,
+            "queue_depth_p99": _percentile(sorted(depths), 0.99) if depths else 0,
+            "p99_target": self.p99_target,
+        })
+        return stats
+
+    def export_queue_depths(self, path):
+        with self._lock:
+            depths = list(self.queue_depths)
+        with open(path, "w") as f:
+            f.write("time,queue_depth\n")
+            for t, d in depths:
+                f.write(f"{t},{d}\n")
+
+
+def slo_benchmark(pipeline, sample_shape, num_requests, rate):
+    r"""
+    Like ``serve_benchmark``, but rejected requests are counted rather than
+    treated as failures.
+    """
+    futures = []
+    tik = time.time()
+    for _ in range(num_requests):
+        futures.append(pipeline.submit(torch.randn(*sample_shape)))
+        time.sleep(random.expovariate(rate))
+    served = 0
+    for fut in futures:
+        try:
+            fut.wait()
+            served += 1
+        except RuntimeError:
+            pass
+    tok = time.time()
+
+    metrics = pipeline.metrics()
+    metrics["goodput"] = served / (tok - tik)
+    return metrics
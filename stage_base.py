@@ -0,0 +1,368 @@
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+import torch
+from torch.distributed.rpc import RRef
+
+from buffer_pool import BufferPool
+from stage_memory import MemoryTracker
+from startup import deferred_init, materialize
+
+
+# service times and micro-batch timings kept between two collecting calls;
+# older ones are dropped when nobody collects them
+timing_history = 4096
+
+
+class StageBase(torch.nn.Module):
+    r"""
+    Plumbing shared by every pipeline stage: the lock that serializes
+    micro-batches, the buffer pool, memory accounting, and the RRef helpers
+    the master calls.
+
+    Weight initialisation is deferred: a subclass's ``__init__`` runs inside
+    ``deferred_init``, so the layers it defines skip their random init, and
+    it ends by calling ``finish_init()``, which returns right away and fills
+    in the weights on a background thread. The first micro-batch waits for it in ``receive``, so
+    the RPC that constructs the stage, and the master's optimizer setup, no
+    longer wait for the random number generator.
+
+    When ``await_snapshot`` is set the background init is skipped altogether
+    and the stage waits for the master to call ``load_snapshot`` (or
+    ``fill_snapshot`` the first time a model is run).
+
+    ``prefetch_depth`` bounds how many micro-batch inputs are pulled ahead of
+    compute (see PrefetchWindow); None pulls every arriving input at once.
+    The master calls ``begin_step`` before each step's micro-batches.
+    """
+    def __init_subclass__(cls, **kwargs):
+        super(StageBase, cls).__init_subclass__(**kwargs)
+        if "__init__" in cls.__dict__:
+            cls.__init__ = _deferring(cls.__dict__["__init__"])
+
+    def __init__(self, prefetch_depth=None, await_snapshot=False):
+        super(StageBase, self).__init__()
+        self.await_snapshot = await_snapshot
+        self._lock = threading.Lock()
+        self.pool = BufferPool()
+        self.memory = MemoryTracker(self)
+        self._service_times = deque(maxlen=timing_history)
+        self._timings = deque(maxlen=timing_history)
+        self._local = threading.local()
+        self._ready = threading.Event()
+        self._init_thread = None
+        self._shards = None
+        self._prefetch = PrefetchWindow(prefetch_depth) if prefetch_depth is not None else None
+
+    def finish_init(self):
+        self.pool.install(self)
+        if not self.await_snapshot:
+            self._init_thread = threading.Thread(target=self._materialize, daemon=True)
+            self._init_thread.start()
+
+    def _materialize(self):
+        materialize(self)
+        self._ready.set()
+
+    def parameter_shapes(self):
+        return [list(p.shape) for p in self.parameters()]
+
+    def load_snapshot(self, path, offset):
+        r"""
+        Map this stage's parameters onto its slice of a weight snapshot. The
+        mapping is copy-on-write, so optimizer steps never touch the file.
+        """
+        from weight_snapshot import Snapshot
+
+        snap = Snapshot(path)
+        for i, p in enumerate(self.parameters()):
+            p.data = snap.tensor(offset + i)
+        for m in self.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.reset_running_stats()
+        self._ready.set()
+
+    def fill_snapshot(self, path, offset):
+        from weight_snapshot import Snapshot
+
+        materialize(self)
+        snap = Snapshot(path, writable=True)
+        for i, p in enumerate(self.parameters()):
+            snap.write(offset + i, p)
+        snap.flush()
+        self._ready.set()
+
+    def _shard_writer(self):
+        if self._shards is None:
+            from checkpoint import ShardWriter
+
+            self._shards = ShardWriter(self)
+        return self._shards
+
+    def save_shard(self, path, optim_rref=None):
+        self._shard_writer().save(path, optim_rref)
+
+    def wait_shard(self, path):
+        return self._shard_writer().wait(path)
+
+    def load_shard(self, path, optim_rref=None):
+        self._shard_writer().load(path, optim_rref)
+
+    def broadcast_parameters(self):
+        r"""
+        Take replica 0's weights. Called on every replica of the stage at
+        once, after replica 0 is ready.
+        """
+        from hybrid import broadcast_module
+
+        if self._init_thread is not None:
+            self._init_thread.join()
+        broadcast_module(self)
+        self._ready.set()
+
+    def allreduce_gradients(self, context_id):
+        from hybrid import allreduce_gradients
+
+        allreduce_gradients(self, context_id)
+
+    def ready(self):
+        self._ready.wait()
+        return True
+
+    def begin_step(self):
+        r"""
+        Start a new step: micro-batch numbers restart from 0, and prefetch
+        slots still held or awaited by a step that failed are given up.
+        """
+        if self._prefetch is not None:
+            self._prefetch.reset()
+
+    def receive(self, x_rref, mb=None):
+        self._ready.wait()
+        arrive = time.time()
+        if self._prefetch is not None and mb is not None:
+            self._local.prefetching = self._prefetch.admit(mb)
+        x = x_rref.to_here()
+        if isinstance(x, torch.Tensor):
+            x = x.to("cpu")
+        self._local.timing = {"mb": mb, "arrive": arrive, "received": time.time()}
+        return x
+
+    def micro_batch(self, x):
+        r"""
+        Scope one micro-batch's compute: holds the stage lock, memory tracking
+        and, under ``infer``, a buffer pool lease. Pass the stage output
+        through ``keep``.
+        """
+        return MicroBatch(self, x)
+
+    def infer(self, x_rref):
+        r"""
+        Run forward for serving: no autograd graph, and pooled buffers can be
+        used for every layer that supports them. The micro-batch's compute
+        time, without the wait for its input or the stage lock, is recorded
+        as a service time.
+        """
+        with torch.inference_mode():
+            return self.forward(x_rref)
+
+    def service_times(self):
+        r"""
+        Return and clear the (micro-batch size, seconds) pairs recorded by
+        ``infer`` since the last call.
+        """
+        times, self._service_times = self._service_times, deque(maxlen=timing_history)
+        return list(times)
+
+    def set_training(self, mode):
+        self.train(mode)
+
+    def cpu_time(self):
+        r"""
+        CPU seconds this worker process has used, forward and backward alike.
+        With one core per stage the difference across a step is the time the
+        stage was busy.
+        """
+        return time.process_time()
+
+    def timings(self):
+        r"""
+        Return and clear the per-micro-batch timings: when the call arrived,
+        when its input was received, when forward compute started and ended
+        (after waiting for the stage lock) and, once the micro-batch has been
+        through backward, when its backward started and ended.
+        """
+        timings, self._timings = self._timings, deque(maxlen=timing_history)
+        return list(timings)
+
+    def buffer_stats(self):
+        return self.pool.stats()
+
+    def memory_begin(self):
+        self.memory.reset()
+        self.memory.start_sampling()
+
+    def memory_report(self):
+        self.memory.stop_sampling()
+        return self.memory.report()
+
+    def parameter_rrefs(self):
+        r"""
+        Create one RRef for each parameter in the given local module, and return a
+        list of RRefs. Parameters of sharded layers live on their shard workers.
+        """
+        from tensor_parallel import remote_parameter_rrefs
+
+        return [RRef(p) for p in self.parameters()] + remote_parameter_rrefs(self)
+
+
+def _deferring(init):
+    r"""
+    Run a stage constructor inside ``deferred_init``, so the skipped
+    initialisation is scoped to it even if it raises.
+    """
+    @wraps(init)
+    def __init__(self, *args, **kwargs):
+        with deferred_init():
+            init(self, *args, **kwargs)
+    return __init__
+
+
+class MicroBatch(object):
+    def __init__(self, stage, x):
+        self.stage = stage
+        self.x = x
+        self._lease_scope = None
+        self._tracked = None
+        self.lease = None
+        self.inference = False
+
+    def __enter__(self):
+        self.stage._lock.acquire()
+        generation = getattr(self.stage._local, "prefetching", None)
+        if generation is not None:
+            self.stage._local.prefetching = None
+            self.stage._prefetch.started(generation)
+        self.timing = getattr(self.stage._local, "timing", None) or {"mb": None}
+        self.stage._local.timing = None
+        self.timing["start"] = time.time()
+        # layer outputs are only pooled without a graph (see BufferPool)
+        self.inference = not torch.is_grad_enabled()
+        if self.inference:
+            self._lease_scope = self.stage.pool.lease()
+            self.lease = self._lease_scope.__enter__()
+        self._tracked = self.stage.memory.track(self.x)
+        self._tracked.__enter__()
+        return self
+
+    def copy_out(self, t):
+        r"""
+        Copy ``t`` out of the lease if it shares memory with a pooled buffer,
+        for outputs that leave the stage besides the one passed to ``keep``.
+        """
+        return self.lease.keep(t) if self.lease is not None else t
+
+    def keep(self, out):
+        out = self.copy_out(out)
+        self._tracked.finish(out)
+        time_backward(out, self.timing)
+        return out
+
+    def __exit__(self, *exc):
+        try:
+            self._tracked.__exit__(*exc)
+            if self._lease_scope is not None:
+                self._lease_scope.__exit__(*exc)
+        finally:
+            self.timing["end"] = time.time()
+            self.stage._timings.append(self.timing)
+            if self.inference and isinstance(self.x, torch.Tensor):
+                self.stage._service_times.append((self.x.size(0), self.timing["end"] - self.timing["start"]))
+            self.stage._lock.release()
+        return False
+
+
+def time_backward(out, timing):
+    r"""
+    Record in ``timing`` when backward reaches ``out`` and when the last
+    node of this micro-batch's graph has run (the one before the parameter
+    accumulators, or the received input's send back upstream). The hooks go
+    on per-micro-batch nodes only, so they are freed with the graph. Does
+    nothing without a graph.
+    """
+    if not isinstance(out, torch.Tensor) or out.grad_fn is None:
+        return
+
+    def started(grad):
+        timing["backward_start"] = time.time()
+
+    def finished(grad_inputs, grad_outputs):
+        timing["backward_end"] = max(time.time(), timing.get("backward_end", 0.0))
+
+    out.register_hook(started)
+    seen = set()
+    stack = [out.grad_fn]
+    while stack:
+        fn = stack.pop()
+        if fn in seen:
+            continue
+        seen.add(fn)
+        nexts = [f for f, _ in fn.next_functions
+                 if f is not None and type(f).__name__ != "AccumulateGrad"]
+        if nexts:
+            stack.extend(nexts)
+        else:
+            fn.register_hook(finished)
+
+
+class PrefetchWindow(object):
+    r"""
+    Admit micro-batch inputs to ``to_here`` in micro-batch order, at most
+    ``depth`` ahead of compute: while one micro-batch computes, the next
+    ``depth`` are pulled from upstream (1 is double buffering). Inputs
+    further ahead wait without starting their transfer, so they do not
+    compete with compute for the stage's core.
+
+    ``reset`` starts a new step. Slots are tagged with the step's generation,
+    so waiters and holders left over from an earlier step cannot take or
+    give back slots of the new one.
+    """
+    def __init__(self, depth):
+        if depth < 1:
+            raise ValueError(f"prefetch depth must be at least 1, got {depth}")
+        self.depth = depth
+        self.held = 0
+        self.next_mb = 0
+        self.generation = 0
+        self.cv = threading.Condition()
+
+    def reset(self):
+        with self.cv:
+            self.generation += 1
+            self.held = 0
+            self.next_mb = 0
+            self.cv.notify_all()
+
+    def admit(self, mb):
+        r"""
+        Wait for ``mb``'s slot and return the generation it was taken in, or
+        None if a reset ended the step first.
+        """
+        with self.cv:
+            generation = self.generation
+            self.cv.wait_for(lambda: self.generation != generation or
+                             (mb == self.next_mb and self.held < self.depth))
+            if self.generation != generation:
+                return None
+            self.next_mb += 1
+            self.held += 1
+            self.cv.notify_all()
+            return generation
+
+    def started(self, generation):
+        with self.cv:
+            if generation == self.generation:
+                self.held -= 1
+                self.cv.notify_all()
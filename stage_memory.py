@@ -0,0 +1,201 @@
+import threading
+import time
+
+import torch
+import torch.distributed.rpc as rpc
+
+
+class MemoryTracker(object):
+    r"""
+    Account for the memory one stage holds: parameters, activations saved for
+    backward by each in-flight micro-batch, and the tensors that crossed the
+    stage boundary. Resident set size is sampled in a background thread so the
+    peak over a step is visible, not just the value at the end.
+    """
+    def __init__(self, module):
+        self.module = module
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampling = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.saved_bytes = 0
+            self.peak_saved_bytes = 0
+            self.transfer_bytes = 0
+            self.peak_transfer_bytes = 0
+            self.micro_batch_saved_bytes = []
+            self.peak_rss = 0
+            self.rss_samples = 0
+
+    def parameter_bytes(self):
+        return sum(_nbytes(p) for p in self.module.parameters())
+
+    def buffer_bytes(self):
+        return sum(_nbytes(b) for b in self.module.buffers())
+
+    def track(self, x):
+        return _TrackedMicroBatch(self, x)
+
+    def start_sampling(self, interval=0.005):
+        if self._sampler is not None:
+            return
+        import psutil
+        proc = psutil.Process()
+        self._sampling.set()
+
+        def _sample():
+            while self._sampling.is_set():
+                rss = proc.memory_info().rss
+                with self._lock:
+                    self.peak_rss = max(self.peak_rss, rss)
+                    self.rss_samples += 1
+                time.sleep(interval)
+
+        self._sampler = threading.Thread(target=_sample, daemon=True)
+        self._sampler.start()
+
+    def stop_sampling(self):
+        if self._sampler is None:
+            return
+        self._sampling.clear()
+        self._sampler.join()
+        self._sampler = None
+
+    def report(self):
+        with self._lock:
+            per_mb = list(self.micro_batch_saved_bytes)
+            return {
+                "worker": rpc.get_worker_info().name,
+                "parameter_bytes": self.parameter_bytes(),
+                "buffer_bytes": self.buffer_bytes(),
+                "peak_saved_bytes": self.peak_saved_bytes,
+                "saved_bytes_per_micro_batch": max(per_mb) if per_mb else 0,
+                "peak_in_flight": self.peak_in_flight,
+                "peak_transfer_bytes": self.peak_transfer_bytes,
+                "peak_rss": self.peak_rss,
+                "rss_samples": self.rss_samples,
+            }
+
+    def _begin(self, saved, transfer):
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.saved_bytes += saved
+            self.peak_saved_bytes = max(self.peak_saved_bytes, self.saved_bytes)
+            self.transfer_bytes += transfer
+            self.peak_transfer_bytes = max(self.peak_transfer_bytes, self.transfer_bytes)
+            self.micro_batch_saved_bytes.append(saved)
+
+    def _end(self, saved, transfer):
+        with self._lock:
+            self.in_flight -= 1
+            self.saved_bytes -= saved
+            self.transfer_bytes -= transfer
+
+
+class _TrackedMicroBatch(object):
+    r"""
+    Count the bytes autograd saves while one micro-batch runs forward, and hand
+    them back once backward has gone through the stage.
+    """
+    def __init__(self, tracker, x):
+        self.tracker = tracker
+        self.x = x
+        self.saved = {}
+        self._hooks = None
+        self._params = None
+
+    def __enter__(self):
+        self._params = {p.data_ptr() for p in self.tracker.module.parameters()}
+
+        def pack(t):
+            ptr = t.data_ptr()
+            if ptr not in self._params and ptr != self.x.data_ptr():
+                self.saved[ptr] = _nbytes(t)
+            return t
+
+        def unpack(t):
+            return t
+
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(pack, unpack)
+        self._hooks.__enter__()
+        return self
+
+    def finish(self, out):
+        saved = sum(self.saved.values())
+        transfer = _nbytes(self.x) + _nbytes(out)
+        self.tracker._begin(saved, transfer)
+
+        # gradient w.r.t. the stage input is the last thing backward computes
+        # here; the first stage has no such input, so fall back to its output.
+        anchor = self.x if self.x.requires_grad else out
+        if not anchor.requires_grad:
+            self.tracker._end(saved, transfer)
+            return
+
+        def _hook(grad):
+            self.tracker._end(saved, transfer)
+
+        anchor.register_hook(_hook)
+
+    def __exit__(self, *exc):
+        self._hooks.__exit__(*exc)
+        return False
+
+
+def optimizer_state_bytes(opt):
+    r"""
+    Ask every worker how much state its local optimizer holds for a
+    DistributedOptimizer, keyed by worker name.
+    """
+    futs = []
+    for optim_rref in opt.remote_optimizers:
+        futs.append(rpc.rpc_async(optim_rref.owner(), _local_optimizer_state_bytes, args=(optim_rref,)))
+    result = {}
+    for optim_rref, nbytes in zip(opt.remote_optimizers, torch.futures.wait_all(futs)):
+        name = optim_rref.owner().name
+        result[name] = result.get(name, 0) + nbytes
+    return result
+
+
+def _local_optimizer_state_bytes(optim_rref):
+    # _LocalOptimizer keeps the wrapped torch.optim instance in ``optim``
+    local_optim = optim_rref.local_value().optim
+    total = 0
+    for state in local_optim.state.values():
+        for v in state.values():
+            if isinstance(v, torch.Tensor):
+                total += _nbytes(v)
+    return total
+
+
+def print_memory_report(reports, opt_bytes, step_time):
+    r"""
+    One row per stage. Optimizer state is only known per worker, so with
+    several stages on one worker it is shown on the first of them and the
+    others show "-".
+    """
+    mb = 1024 * 1024
+    print(f"step time: {step_time:.3f}s")
+    print(f"{'stage':<8}{'params MB':>12}{'optim MB':>12}{'saved MB':>12}"
+          f"{'per mb MB':>12}{'in flight':>12}{'transfer MB':>14}{'peak rss MB':>14}")
+    shown = set()
+    for i, r in enumerate(reports):
+        optim = "-" if r["worker"] in shown else f"{opt_bytes.get(r['worker'], 0) / mb:.1f}"
+        shown.add(r["worker"])
+        print(f"{i:<8}"
+              f"{r['parameter_bytes'] / mb:>12.1f}"
+              f"{optim:>12}"
+              f"{r['peak_saved_bytes'] / mb:>12.1f}"
+              f"{r['saved_bytes_per_micro_batch'] / mb:>12.1f}"
+              f"{r['peak_in_flight']:>12}"
+              f"{r['peak_transfer_bytes'] / mb:>14.1f}"
+              f"{r['peak_rss'] / mb:>14.1f}")
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
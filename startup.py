@@ -0,0 +1,86 @@
+import threading
+import time
+
+import torch
+
+
+class StartupTimer(object):
+    r"""
+    Wall-clock breakdown of process startup into named phases, each measured
+    from the end of the previous one.
+    """
+    def __init__(self, t0):
+        self.t0 = t0
+        self.last = t0
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, who):
+        for phase, seconds in self.phases:
+            print(f"{who} startup {phase}: {seconds:.3f}s")
+        print(f"{who} startup total: {self.last - self.t0:.3f}s", flush=True)
+
+
+# Layers whose constructors draw random weights. Their reset_parameters is
+# wrapped once so that it does nothing on a thread that is inside
+# ``deferred_init``; every other thread, and every other module built at the
+# same time, still gets the usual initialisation. ``materialize`` calls the
+# original functions directly, so it does not depend on what other threads
+# are constructing.
+_DEFERRED = (torch.nn.Conv2d, torch.nn.Linear, torch.nn.BatchNorm2d)
+_original = {cls: cls.reset_parameters for cls in _DEFERRED}
+_installed = False
+_install_lock = threading.Lock()
+_local = threading.local()
+
+
+def _skippable(reset):
+    def reset_parameters(self):
+        if not getattr(_local, "depth", 0):
+            reset(self)
+    return reset_parameters
+
+
+def _install():
+    global _installed
+    with _install_lock:
+        if not _installed:
+            for cls in _DEFERRED:
+                cls.reset_parameters = _skippable(_original[cls])
+            _installed = True
+
+
+class deferred_init(object):
+    r"""
+    Scope in which layers built by the calling thread skip their random
+    initialisation. Nests, and always unwinds, even when the constructor
+    inside it raises.
+    """
+    def __enter__(self):
+        _install()
+        _local.depth = getattr(_local, "depth", 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        _local.depth -= 1
+        return False
+
+
+def materialize(module):
+    r"""
+    Run the initialisation skipped during construction: each layer's default
+    reset_parameters, then the module's own ``_initialize_weights`` if it has
+    one.
+    """
+    with torch.no_grad():
+        for m in module.modules():
+            for cls in _DEFERRED:
+                if isinstance(m, cls):
+                    _original[cls](m)
+                    break
+        if hasattr(module, "_initialize_weights"):
+            module._initialize_weights()
@@ -0,0 +1,138 @@
+r"""
+Tensor parallelism for the large Linear layers of a stage. A sharded layer
+keeps a slice of its weight on each of a few shard workers and stands in
+for the nn.Linear it replaces, so the stage's forward is unchanged:
+
+    column    shard i holds output features [i * out / k, (i + 1) * out / k);
+              every shard gets the whole input and the outputs are
+              concatenated (all-gather)
+    row       shard i holds input features [i * in / k, (i + 1) * in / k);
+              every shard gets its slice of the input and the partial outputs
+              are summed (reduce), the bias is added on the stage
+
+The shard calls are RPCs made inside the stage's forward, so distributed
+autograd records them and backward does the matching reduce (column) or
+all-gather (row) of the input gradient.
+"""
+import math
+
+import torch
+import torch.distributed.rpc as rpc
+import torch.nn as nn
+from torch.distributed.rpc import RRef
+
+
+class LinearShard(nn.Module):
+    r"""
+    One worker's slice of a sharded Linear. Initialised like the full layer:
+    the default uniform bound uses the full layer's ``fan_in``, or
+    normal(0, ``init_std``) with zero bias for models that re-initialise.
+    """
+    def __init__(self, in_features, out_features, bias, fan_in, init_std=None):
+        super(LinearShard, self).__init__()
+        self.weight = nn.Parameter(torch.empty(out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(out_features)) if bias else None
+        with torch.no_grad():
+            _init(self.weight, self.bias, fan_in, init_std)
+
+    def forward(self, x):
+        return torch.nn.functional.linear(x, self.weight, self.bias)
+
+    def parameter_rrefs(self):
+        return [RRef(p) for p in self.parameters()]
+
+
+def _init(weight, bias, fan_in, init_std):
+    if init_std is not None:
+        if weight is not None:
+            nn.init.normal_(weight, 0, init_std)
+        if bias is not None:
+            nn.init.constant_(bias, 0)
+    else:
+        bound = 1 / math.sqrt(fan_in)
+        if weight is not None:
+            nn.init.uniform_(weight, -bound, bound)
+        if bias is not None:
+            nn.init.uniform_(bias, -bound, bound)
+
+
+def _split(n, k):
+    bounds = [round(i * n / k) for i in range(k + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class ColumnParallelLinear(nn.Module):
+    def __init__(self, workers, in_features, out_features, bias=True, init_std=None):
+        super(ColumnParallelLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.shards = [
+            rpc.remote(w, LinearShard, args=(in_features, end - start, bias, in_features, init_std))
+            for w, (start, end) in zip(workers, _split(out_features, len(workers)))
+        ]
+
+    def forward(self, x):
+        outs = torch.futures.wait_all([s.rpc_async().forward(x) for s in self.shards])
+        return torch.cat(outs, dim=1)
+
+
+class RowParallelLinear(nn.Module):
+    def __init__(self, workers, in_features, out_features, bias=True, init_std=None):
+        super(RowParallelLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.slices = _split(in_features, len(workers))
+        self.shards = [
+            rpc.remote(w, LinearShard, args=(end - start, out_features, False, in_features, init_std))
+            for w, (start, end) in zip(workers, self.slices)
+        ]
+        self.bias = None
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features))
+            with torch.no_grad():
+                _init(None, self.bias, in_features, init_std)
+
+    def forward(self, x):
+        outs = torch.futures.wait_all([
+            s.rpc_async().forward(x[:, start:end].contiguous())
+            for s, (start, end) in zip(self.shards, self.slices)
+        ])
+        out = torch.stack(outs).sum(dim=0)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+
+PARALLEL_LINEAR = {
+    "column": ColumnParallelLinear,
+    "row": RowParallelLinear,
+}
+
+
+def shard_linears(module, layout, workers, init_std=None):
+    r"""
+    Replace the Linear attributes of ``module`` named in ``layout`` (name ->
+    "column" or "row") with sharded versions spread over ``workers``.
+    """
+    for name, kind in layout.items():
+        linear = getattr(module, name)
+        setattr(module, name, PARALLEL_LINEAR[kind](
+            workers,
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            init_std=init_std
+        ))
+
+
+def remote_parameter_rrefs(module):
+    r"""
+    RRefs to the parameters held by the shard workers of every sharded layer
+    in ``module``, for the DistributedOptimizer.
+    """
+    futs = [
+        s.rpc_async().parameter_rrefs()
+        for m in module.modules() if isinstance(m, tuple(PARALLEL_LINEAR.values()))
+        for s in m.shards
+    ]
+    return [r for rrefs in torch.futures.wait_all(futs) for r in rrefs]
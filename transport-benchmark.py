@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed.rpc as rpc
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from p2p_transport import init_p2p
+from pipeline import DistLayerPipeline
+from schedule import ScheduledPipeline
+
+num_classes = 1000
+
+
+#########################################################
+#                      Benchmark                        #
+#########################################################
+
+# train each model under the same schedule with activations and gradients
+# moved over RPC and over torch.distributed isend/irecv, and compare the
+# step times
+models = {
+    "alexnet": (128, 128),
+    "vgg": (128, 128),
+    "resnet": (256, 256),
+}
+transports = ["rpc", "p2p"]
+schedule = "1f1b"
+num_workers = 4
+split_sizes = [1, 8]
+num_batches = 3
+# the first p2p step runs over RPC to record receive shapes
+warmup_batches = 1
+batch_size = 128
+results_json = "transport_results.json"
+
+
+def make_batch(image_w, image_h):
+    one_hot_indices = torch.LongTensor(batch_size) \
+                           .random_(0, num_classes) \
+                           .view(batch_size, 1)
+    inputs = torch.randn(batch_size, 3, image_w, image_h)
+    labels = torch.zeros(batch_size, num_classes) \
+                  .scatter_(1, one_hot_indices, 1)
+    return inputs, labels
+
+
+def run_master(model_name, image_w, image_h, split_size, transport, workers, results):
+    model = DistLayerPipeline(model_name, split_size, workers,
+                              image_w=image_w, image_h=image_h, num_classes=num_classes)
+    trainer = ScheduledPipeline(model, schedule, optim.SGD, nn.MSELoss(), transport, lr=0.05)
+    model.wait_ready()
+    inputs, labels = make_batch(image_w, image_h)
+
+    times = []
+    for i in range(warmup_batches + num_batches):
+        tik = time.time()
+        trainer.train_step(inputs, labels)
+        if i >= warmup_batches:
+            times.append(time.time() - tik)
+    results.put(min(times))
+
+
+def run_worker(rank, world_size, model_name, image_w, image_h, split_size, transport, results):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '29500'
+    options = rpc.TensorPipeRpcBackendOptions(num_worker_threads=256, rpc_timeout=1200)
+
+    import psutil
+    ncores = os.cpu_count()
+    psutil.Process().cpu_affinity([rank % ncores])
+    torch.set_num_threads(1)
+
+    name = "master" if rank == 0 else f"worker{rank}"
+    rpc.init_rpc(name, rank=rank, world_size=world_size, rpc_backend_options=options)
+    if transport == "p2p":
+        init_p2p(rank, world_size)
+    if rank == 0:
+        workers = [f"worker{r}" for r in range(1, world_size)]
+        run_master(model_name, image_w, image_h, split_size, transport, workers, results)
+
+    # block until all rpcs finish
+    rpc.shutdown()
+
+
+def print_table(rows):
+    print(f"{'model':<10}{'split':>6}{'rpc s':>10}{'p2p s':>10}{'speedup':>10}")
+    for r in rows:
+        print(f"{r['model']:<10}{r['split_size']:>6}{r['rpc']:>10.3f}{r['p2p']:>10.3f}{r['rpc'] / r['p2p']:>10.2f}")
+
+
+if __name__=="__main__":
+    world_size = num_workers + 1
+    rows = []
+    for model_name, (image_w, image_h) in models.items():
+        for split_size in split_sizes:
+            row = {"model": model_name, "split_size": split_size}
+            for transport in transports:
+                ctx = mp.get_context("spawn")
+                results = ctx.SimpleQueue()
+                mp.spawn(run_worker, args=(world_size, model_name, image_w, image_h, split_size, transport, results),
+                         nprocs=world_size, join=True)
+                row[transport] = results.get()
+                print(f"{model_name} split {split_size} {transport}: {row[transport]:.3f} s", flush=True)
+            rows.append(row)
+
+    print_table(rows)
+    with open(results_json, "w") as f:
+        json.dump(rows, f, indent=2)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+
+# Snapshot file layout (the same idea as safetensors):
+#
+#     8 bytes       little-endian u64, length of the JSON header
+#     header        {"__metadata__": {...}, "param<i>": {"dtype", "shape", "data_offsets"}}
+#     data          raw float32 values, offsets relative to the end of the header
+#
+# Parameters are numbered in model order (stage 0 first, then each stage's
+# registration order). Moving a cut between stages does not change that order,
+# so every partition of the same model maps the same file.
+
+
+def snapshot_path(snapshot_dir, name, shapes):
+    r"""
+    Where the snapshot for a model with the given per-stage parameter shapes
+    lives. The key covers the flattened shape list only, not the partition.
+    """
+    flat = [list(s) for stage in shapes for s in stage]
+    key = hashlib.sha1(json.dumps(flat).encode()).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f"{name}-{key}.snap")
+
+
+def stage_offsets(shapes):
+    offsets = []
+    total = 0
+    for stage in shapes:
+        offsets.append(total)
+        total += len(stage)
+    return offsets
+
+
+def create_snapshot(path, shapes, name):
+    r"""
+    Write the header for an empty snapshot and size the file; the stages fill
+    in their own slices.
+    """
+    header = {"__metadata__": {"model": name}}
+    begin = 0
+    index = 0
+    for stage in shapes:
+        for shape in stage:
+            n = 4 * int(np.prod(shape))
+            header[f"param{index}"] = {"dtype": "F32", "shape": list(shape), "data_offsets": [begin, begin + n]}
+            begin += n
+            index += 1
+    raw = json.dumps(header).encode()
+    raw += b" " * (-len(raw) % 8)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<Q", len(raw)))
+        f.write(raw)
+        f.truncate(8 + len(raw) + begin)
+    return tmp
+
+
+class Snapshot(object):
+    def __init__(self, path, writable=False):
+        self.path = path
+        with open(path, "rb") as f:
+            (n,) = struct.unpack("<Q", f.read(8))
+            self.header = json.loads(f.read(n))
+        self.data_start = 8 + n
+        # copy-on-write: training updates stay private to the process
+        self._map = np.memmap(path, dtype=np.uint8, mode="r+" if writable else "c")
+
+    def _view(self, index):
+        entry = self.header[f"param{index}"]
+        begin, end = entry["data_offsets"]
+        raw = self._map[self.data_start + begin:self.data_start + end]
+        return raw.view(np.float32).reshape(entry["shape"])
+
+    def tensor(self, index):
+        return torch.from_numpy(self._view(index))
+
+    def write(self, index, t):
+        self._view(index)[...] = t.detach().numpy()
+
+    def flush(self):
+        self._map.flush()
+
+
+def load_or_create(stage_rrefs, snapshot_dir, name):
+    r"""
+    Point every stage at its slice of the model's snapshot, generating the
+    snapshot first if this model has never been run. On a miss each stage
+    initialises its weights as usual and writes them into its own slice; on
+    a hit the stages only map the file.
+    """
+    shapes = torch.futures.wait_all([s.rpc_async().parameter_shapes() for s in stage_rrefs])
+    path = snapshot_path(snapshot_dir, name, shapes)
+    offsets = stage_offsets(shapes)
+
+    if os.path.exists(path):
+        torch.futures.wait_all([
+            s.rpc_async().load_snapshot(path, offset) for s, offset in zip(stage_rrefs, offsets)
+        ])
+        return path, True
+
+    tmp = create_snapshot(path, shapes, name)
+    torch.futures.wait_all([
+        s.rpc_async().fill_snapshot(tmp, offset) for s, offset in zip(stage_rrefs, offsets)
+    ])
+    os.replace(tmp, path)
+    return path, False